@@ -14,6 +14,8 @@ from flask_wtf.csrf import CSRFProtect
 from config import config
 from .models import Admin, SiteConfig
 from .context_processors import site_config
+from .utils.cache import memory_cache, tag_versions
+from .utils.file import UploadRequest
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -44,6 +46,8 @@ def create_app(config_name='development'):
 
     # 设置最大上传文件大小为 64MB
     app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
+    # 上传文件在解析表单时直接写入上传目录
+    app.request_class = UploadRequest
 
     # 确保设置了时区
     if 'TIMEZONE' not in app.config:
@@ -60,6 +64,8 @@ def create_app(config_name='development'):
     moment.init_app(app)
     limiter.init_app(app)
     csrf.init_app(app)
+    memory_cache.init_app(app)
+    tag_versions.init_app(app)
 
     # 注册上下文处理器
     app.context_processor(site_config)
@@ -73,6 +79,11 @@ def create_app(config_name='development'):
 
     app.register_blueprint(admin_blueprint, url_prefix='/admin')
 
+    # 注册命令行工具
+    from .commands import register_commands
+
+    register_commands(app)
+
     def init_site_config():
         """初始化网站配置"""
         if SiteConfig.objects.count() == 0:
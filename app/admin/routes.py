@@ -13,7 +13,6 @@ from flask import (
     flash,
     jsonify,
     current_app,
-    send_file,
 )
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
@@ -23,16 +22,30 @@ from ..models import (
     Post,
     SiteConfig,
     get_utc_time,
-    convert_to_local_time,
     Message,
     IPRecord,
     Category,
     SiteShare,
+    Attachment,
 )
 from ..utils.security import sanitize_string, validate_object_id
+from ..utils.cache import invalidate_tags, get_cache_report, purge_views, memory_cache
+from ..utils.render import render_post_markdown, excerpt_length, rebuild_excerpts
+from ..utils import counters
+from ..utils.pagination import NumberedPage, TITLE_FILTER_HINT
+from ..utils.search import remove_posts
 from flask_wtf.csrf import validate_csrf
 import glob
-from app.utils.file import ensure_upload_folder, save_file
+from app.utils.file import (
+    ensure_upload_folder,
+    save_file,
+    save_upload,
+    release_file,
+    release_files,
+    send_attachment,
+    delete_files_async,
+)
+from bson import ObjectId
 
 
 @admin.route('/')
@@ -81,6 +94,10 @@ def logout():
     return redirect(url_for('admin.login'))
 
 
+# 后台文章列表显示的字段
+DASHBOARD_FIELDS = ('title', 'categories', 'created_at', 'updated_at', 'is_pinned', 'is_visible')
+
+
 @admin.route('/dashboard')
 @login_required
 def dashboard():
@@ -90,73 +107,58 @@ def dashboard():
     """
     page = request.args.get('page', 1, type=int)
     per_page = 10
-
-    # 获取总文档数
-    total = Post.objects.count()
-
-    # 获取当前页的文档，按置顶和更新时间排序
-    posts = (
-        Post.objects.order_by('-is_pinned', '-updated_at', '-created_at')
-        .skip((page - 1) * per_page)
-        .limit(per_page)
+    title = request.args.get('title', '').strip()
+    category_id = request.args.get('category', '')
+    visibility = request.args.get('visibility', '')
+    categories = Category.get_all()
+
+    # 筛选条件，标题按开头匹配以使用 title 索引
+    query = {}
+    if title:
+        query['title__startswith'] = title
+    if category_id in {str(category.id) for category in categories}:
+        query['categories'] = ObjectId(category_id)
+    else:
+        category_id = ''
+    if visibility in ('visible', 'hidden'):
+        query['is_visible'] = visibility == 'visible'
+    else:
+        visibility = ''
+    queryset = Post.objects(**query)
+    if title:
+        queryset = queryset.hint(TITLE_FILTER_HINT)
+
+    # 有对应计数器的筛选组合读取计数器，其余组合直接统计
+    if not query:
+        total = counters.get(counters.POSTS, queryset.count)
+    elif query == {'is_visible': True}:
+        total = counters.get(counters.VISIBLE_POSTS, queryset.count)
+    elif category_id and query == {'is_visible': True, 'categories': ObjectId(category_id)}:
+        total = counters.get(counters.category_counter(category_id), queryset.count)
+    else:
+        total = None
+
+    # 只读取列表显示的字段，分类由进程内快照解析
+    posts = NumberedPage(
+        queryset.only(*DASHBOARD_FIELDS)
+        .no_dereference()
+        .order_by('-is_pinned', '-updated_at', '-created_at', '-id'),
+        page,
+        per_page,
+        total=total,
+    )
+    filters = {
+        key: value
+        for key, value in (
+            ('title', title),
+            ('category', category_id),
+            ('visibility', visibility),
+        )
+        if value
+    }
+    return render_template(
+        'admin/dashboard.html', posts=posts, categories=categories, filters=filters
     )
-
-    # 创建分页对象
-    class Pagination:
-        def __init__(self, page, per_page, total):
-            self.page = page
-            self.per_page = per_page
-            self.total = total
-            self.items = []
-            self.pages = (total + per_page - 1) // per_page
-
-            # 转换时间为本地时间
-            for post in posts:
-                post.created_at = convert_to_local_time(post.created_at)
-                post.updated_at = convert_to_local_time(post.updated_at)
-                self.items.append(post)
-
-        @property
-        def has_prev(self):
-            """是否有上一页"""
-            return self.page > 1
-
-        @property
-        def has_next(self):
-            """是否有下一页"""
-            return self.page < self.pages
-
-        @property
-        def prev_num(self):
-            """上一页页码"""
-            return self.page - 1
-
-        @property
-        def next_num(self):
-            """下一页页码"""
-            return self.page + 1
-
-        def iter_pages(self):
-            """生成分页导航的页码"""
-            left_edge = 2
-            left_current = 2
-            right_current = 3
-            right_edge = 2
-
-            last = 0
-            for num in range(1, self.pages + 1):
-                if (
-                    num <= left_edge
-                    or (num > self.page - left_current - 1 and num < self.page + right_current)
-                    or num > self.pages - right_edge
-                ):
-                    if last + 1 != num:
-                        yield None
-                    yield num
-                    last = num
-
-    pagination = Pagination(page, per_page, total)
-    return render_template('admin/dashboard.html', posts=pagination)
 
 
 @admin.route('/post/new', methods=['GET', 'POST'])
@@ -185,7 +187,7 @@ def new_post():
                 if not os.path.exists(upload_folder):
                     os.makedirs(upload_folder)
                 md_file_path = os.path.join(upload_folder, filename)
-                md_file.save(md_file_path)
+                save_upload(md_file, md_file_path)
             else:
                 flash('请上传Markdown文件')
                 return render_template('admin/edit_post.html', categories=categories)
@@ -213,7 +215,14 @@ def new_post():
                 current_app.logger.info(f"[日志] 附件保存成功: {file_info}")
         if attachments:
             post.attachments = attachments
+        if is_markdown:
+            try:
+                render_post_markdown(post)
+            except Exception as e:
+                current_app.logger.warning(f"[日志] Markdown 预渲染失败: {e}")
         post.save()
+        counters.move(set(), counters.post_counters(post))
+        invalidate_tags('post-list')
         current_app.logger.info(f"[日志] 文章创建成功，ID: {post.id}")
         flash('文章已创建')
         return redirect(url_for('admin.dashboard'))
@@ -241,6 +250,7 @@ def edit_post(post_id):
 
         if request.method == 'POST':
             has_changes = False
+            counted = counters.post_counters(post)
 
             # 清理并验证输入
             title = sanitize_string(request.form.get('title'))
@@ -272,7 +282,7 @@ def edit_post(post_id):
                             os.remove(post.md_file_path)
                         except Exception as e:
                             current_app.logger.warning(f"删除旧Markdown文件失败: {e}")
-                    md_file.save(md_file_path_new)
+                    save_upload(md_file, md_file_path_new)
                     md_file_path = md_file_path_new
                 elif not md_file_path:
                     flash('请上传Markdown文件')
@@ -339,9 +349,22 @@ def edit_post(post_id):
                             )
                             has_changes = True
 
+            if is_markdown:
+                try:
+                    if render_post_markdown(post):
+                        current_app.logger.info("[日志] Markdown 内容已重新渲染")
+                        has_changes = True
+                except Exception as e:
+                    current_app.logger.warning(f"[日志] Markdown 预渲染失败: {e}")
+                    # 清除旧的渲染结果，详情页将重新渲染并显示错误
+                    post.source_hash = None
+                    has_changes = True
+
             if has_changes:
                 post.updated_at = get_utc_time()
                 post.save()
+                counters.move(counted, counters.post_counters(post))
+                invalidate_tags(f'post:{post.id}', 'post-list')
                 current_app.logger.info(f"[日志] 文章更新成功，ID: {post_id}")
                 flash('文章已更新')
             else:
@@ -382,24 +405,22 @@ def delete_post(post_id):
         post = Post.objects(id=validate_object_id(post_id)).first_or_404()
         current_app.logger.info(f"找到要删除的文章: {post.title}")
 
-        # 删除所有附件文件
+        # 释放附件文件，没有其他文章或留言引用的文件被删除
         if post.attachments:
-            upload_folder = ensure_upload_folder()
-            current_app.logger.info(f"开始删除附件文件，共 {len(post.attachments)} 个")
+            current_app.logger.info(f"开始释放附件文件，共 {len(post.attachments)} 个")
 
             for attachment in post.attachments:
-                file_path = upload_folder / attachment['stored_filename']
                 try:
-                    if file_path.exists():
-                        current_app.logger.info(f"删除附件文件: {attachment['filename']}")
-                        file_path.unlink()
+                    release_file(attachment['stored_filename'])
                 except Exception as e:
                     current_app.logger.error(
-                        f"删除附件文件失败: {attachment['filename']}, 错误: {str(e)}"
+                        f"释放附件文件失败: {attachment['filename']}, 错误: {str(e)}"
                     )
 
         # 删除文章记录
         post.delete()
+        counters.move(counters.post_counters(post), set())
+        invalidate_tags(f'post:{post.id}', 'post-list')
         current_app.logger.info(f"文章删除成功，ID: {post_id}")
         return jsonify({'status': 'success'})
 
@@ -419,6 +440,7 @@ def settings():
         try:
             # 获取所有配置项
             configs = SiteConfig.objects
+            old_excerpt_length = excerpt_length()
 
             # 先处理所有布尔类型的配置，将未出现在表单中的设置为 false
             bool_configs = configs(type='bool')
@@ -439,6 +461,12 @@ def settings():
                         config.value = str(value)
                     config.save()
 
+            invalidate_tags('site-config')
+            # 预览长度调大后已保存的摘要不够长，按新的长度重新生成
+            if excerpt_length() > old_excerpt_length:
+                updated = rebuild_excerpts()
+                invalidate_tags('post-list')
+                current_app.logger.info(f'预览长度已调整，更新 {updated} 篇文章的摘要')
             current_app.logger.info('网站设置已更新')
             flash('设置已保存', 'success')
         except Exception as e:
@@ -465,22 +493,19 @@ def download_attachment(post_id, filename):
     """
     try:
         current_app.logger.info(f"开始下载附件，文章ID: {post_id}, 文件名: {filename}")
-        post = Post.objects.get_or_404(id=post_id)
-        attachment = next((a for a in post.attachments if a['stored_filename'] == filename), None)
+        attachment = Attachment.find(filename, post_id=validate_object_id(post_id))
 
         if not attachment:
             current_app.logger.warning(f"附件不存在: {filename}")
             return '附件不存在', 404
 
-        upload_folder = ensure_upload_folder()
-        file_path = upload_folder / filename
-
-        if not file_path.exists():
-            current_app.logger.warning(f"文件不存在: {file_path}")
+        response = send_attachment(filename, attachment.original_filename)
+        if response is None:
+            current_app.logger.warning(f"文件不存在: {filename}")
             return '文件不存在', 404
 
-        current_app.logger.info(f"开始发送文件: {attachment['filename']}")
-        return send_file(str(file_path), download_name=attachment['filename'], as_attachment=True)
+        current_app.logger.info(f"开始发送文件: {attachment.original_filename}")
+        return response
 
     except Exception as e:
         current_app.logger.error(f"下载附件失败: {str(e)}")
@@ -514,16 +539,13 @@ def delete_attachment(post_id, filename):
         for i, attachment in enumerate(post.attachments):
             if attachment['stored_filename'] == filename:
                 try:
-                    upload_folder = ensure_upload_folder()
-                    file_path = upload_folder / filename
-                    if file_path.exists():
-                        current_app.logger.info(f"删除文件: {file_path}")
-                        file_path.unlink()
-
                     current_app.logger.info(f"从数据库中移除附件记录: {attachment['filename']}")
                     post.attachments.pop(i)
                     post.updated_at = get_utc_time()
                     post.save()
+                    # 文件可能还被其他文章或留言引用，最后一个引用释放时才删除
+                    release_file(filename)
+                    invalidate_tags(f'post:{post.id}', 'post-list')
                     found = True
                     break
 
@@ -559,6 +581,7 @@ def toggle_pin(post_id):
         # 切换置顶状态
         is_pinned = not post.is_pinned
         Post.objects(id=post_id).update(is_pinned=is_pinned)
+        invalidate_tags('post-list')
         return jsonify({'success': True, 'is_pinned': is_pinned})
     except Exception as e:
         current_app.logger.error(f'切换文章置顶状态失败: {str(e)}')
@@ -581,13 +604,90 @@ def toggle_visibility(post_id):
             return jsonify({'success': False, 'message': '文章不存在'})
         # 切换可见性状态
         is_visible = not post.is_visible
+        counted = counters.post_counters(post)
         Post.objects(id=post_id).update(is_visible=is_visible)
+        post.is_visible = is_visible
+        counters.move(counted, counters.post_counters(post))
+        invalidate_tags(f'post:{post.id}', 'post-list')
         return jsonify({'success': True, 'is_visible': is_visible})
     except Exception as e:
         current_app.logger.error(f'切换文章可见性失败: {str(e)}')
         return jsonify({'success': False, 'message': '操作失败，请重试'})
 
 
+# 支持的批量操作
+BULK_ACTIONS = ('pin', 'unpin', 'show', 'hide', 'set_categories', 'delete')
+
+
+@admin.route('/posts/bulk', methods=['POST'])
+@login_required
+def bulk_posts():
+    """
+    批量操作文章
+
+    表单参数：
+        action: pin、unpin、show、hide、set_categories 或 delete
+        post_ids: 文章ID，可以有多个
+        category_ids: set_categories 时的分类ID，可以有多个，为空时清除分类
+
+    每种操作只执行一次 update_many 或 delete_many，删除时附件文件在后台线程中删除。
+    """
+    token = request.headers.get('X-CSRFToken') or request.form.get('csrf_token')
+    try:
+        validate_csrf(token)
+    except Exception:
+        return jsonify({'success': False, 'message': 'CSRF token missing or invalid'}), 400
+
+    action = request.form.get('action')
+    post_ids = [ObjectId(i) for i in request.form.getlist('post_ids') if ObjectId.is_valid(i)]
+    if action not in BULK_ACTIONS:
+        return jsonify({'success': False, 'message': '不支持的操作'}), 400
+    if not post_ids:
+        return jsonify({'success': False, 'message': '请选择文章'}), 400
+
+    try:
+        queryset = Post.objects(id__in=post_ids)
+        # 计数器需要修改前的可见性和分类，删除时还需要附件列表
+        fields = ['is_visible', 'categories'] + (['attachments'] if action == 'delete' else [])
+        posts = list(queryset.only(*fields).no_dereference())
+        counted = {post.id: counters.post_counters(post) for post in posts}
+
+        if action == 'delete':
+            queryset.delete()
+            remove_posts(counted)
+            Attachment.remove_posts(counted)
+            delete_files_async(
+                release_files(
+                    attachment['stored_filename']
+                    for post in posts
+                    for attachment in post.attachments or ()
+                )
+            )
+            counters.move_many((before, set()) for before in counted.values())
+        elif action in ('pin', 'unpin'):
+            queryset.update(set__is_pinned=action == 'pin')
+        else:
+            if action in ('show', 'hide'):
+                queryset.update(set__is_visible=action == 'show')
+            else:
+                category_ids = [
+                    i for i in request.form.getlist('category_ids') if ObjectId.is_valid(i)
+                ]
+                categories = list(Category.objects(id__in=category_ids)) if category_ids else []
+                queryset.update(set__categories=categories)
+            posts = queryset.only('is_visible', 'categories').no_dereference()
+            counters.move_many(
+                (counted.get(post.id, set()), counters.post_counters(post)) for post in posts
+            )
+
+        invalidate_tags('post-list', *(f'post:{post_id}' for post_id in counted))
+        current_app.logger.info(f"批量操作文章: {action}, 共 {len(counted)} 篇")
+        return jsonify({'success': True, 'count': len(counted)})
+    except Exception as e:
+        current_app.logger.error(f'批量操作文章失败: {str(e)}')
+        return jsonify({'success': False, 'message': '操作失败，请重试'}), 500
+
+
 @admin.route('/admins')
 @login_required
 def admins():
@@ -668,7 +768,12 @@ def messages():
     site_config = SiteConfig.get_message_configs()
     per_page = site_config['messages_per_page']
 
-    pagination = Message.objects.order_by('-created_at').paginate(page=page, per_page=per_page)
+    pagination = NumberedPage(
+        Message.objects.order_by('-created_at'),
+        page,
+        per_page,
+        total=counters.get(counters.MESSAGES, Message.objects.count),
+    )
 
     return render_template('admin/messages.html', pagination=pagination, show_ip=True)
 
@@ -693,14 +798,10 @@ def delete_message(message_id):
     """删除留言"""
     message = Message.objects(id=message_id).first_or_404()
 
-    # 如果有附件，删除附件文件
+    # 如果有附件，释放附件文件
     if message.attachment:
         try:
-            file_path = os.path.join(
-                current_app.config['UPLOAD_FOLDER'], message.attachment['stored_filename']
-            )
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            release_file(message.attachment.get('stored_filename'))
         except Exception as e:
             current_app.logger.error(f'删除附件文件失败：{str(e)}')
 
@@ -711,10 +812,14 @@ def delete_message(message_id):
             ip_record.message_count = max(0, ip_record.message_count - 1)
             if ip_record.message_count == 0 and not ip_record.is_blocked:
                 ip_record.delete()
+                counters.incr(counters.IP_RECORDS, delta=-1)
             else:
                 ip_record.save()
 
     message.delete()
+    counters.incr(counters.MESSAGES, delta=-1)
+    if message.is_public:
+        invalidate_tags('message-wall')
     return jsonify({'success': True})
 
 
@@ -729,6 +834,7 @@ def toggle_message_public(message_id):
 
     message.is_public = not message.is_public
     message.save()
+    invalidate_tags('message-wall')
 
     return jsonify({'success': True})
 
@@ -739,11 +845,14 @@ def toggle_ip_block(ip_address):
     """切换IP限制状态"""
     ip_record = IPRecord.objects(ip_address=ip_address).first()
 
-    if not ip_record:
+    is_new_ip = not ip_record
+    if is_new_ip:
         ip_record = IPRecord(ip_address=ip_address)
 
     ip_record.is_blocked = not ip_record.is_blocked
     ip_record.save()
+    if is_new_ip:
+        counters.incr(counters.IP_RECORDS)
 
     return jsonify({'success': True})
 
@@ -756,8 +865,11 @@ def ip_records():
     per_page = int(SiteConfig.get_config('messages_per_page', 20))  # 使用留言管理的每页显示数量
 
     # 按最后留言时间倒序排序
-    pagination = IPRecord.objects.order_by('-last_message_at').paginate(
-        page=page, per_page=per_page
+    pagination = NumberedPage(
+        IPRecord.objects.order_by('-last_message_at'),
+        page,
+        per_page,
+        total=counters.get(counters.IP_RECORDS, IPRecord.objects.count),
     )
 
     return render_template('admin/ip_records.html', pagination=pagination)
@@ -786,6 +898,7 @@ def category_new():
             return render_template('admin/edit_category.html')
         category = Category(name=name, description=description)
         category.save()
+        invalidate_tags('category')
         flash('分类已创建')
         return redirect(url_for('admin.category_list'))
     return render_template('admin/edit_category.html')
@@ -808,6 +921,7 @@ def category_edit(category_id):
         category.name = name
         category.description = description
         category.save()
+        invalidate_tags('category')
         flash('分类已更新')
         return redirect(url_for('admin.category_list'))
     return render_template('admin/edit_category.html', category=category)
@@ -823,6 +937,7 @@ def category_delete(category_id):
         flash('有文章引用该分类，无法删除')
         return redirect(url_for('admin.category_list'))
     category.delete()
+    invalidate_tags('category')
     flash('分类已删除')
     return redirect(url_for('admin.category_list'))
 
@@ -843,6 +958,33 @@ def view_logs():
     return render_template('admin/logs.html', log_content=log_content)
 
 
+@admin.route('/cache')
+@login_required
+def cache_stats():
+    """缓存统计页面"""
+    try:
+        report = get_cache_report()
+    except Exception as e:
+        current_app.logger.error(f"读取缓存统计失败: {str(e)}")
+        flash('读取缓存统计失败', 'danger')
+        report = []
+    return render_template('admin/cache.html', report=report, memory=memory_cache.info())
+
+
+@admin.route('/cache/purge', methods=['POST'])
+@login_required
+def purge_cache():
+    """清除单个视图或全部视图的缓存"""
+    view = request.form.get('view', '').strip()
+    if view:
+        purge_views(view)
+        flash(f'已清除 {view} 的缓存', 'success')
+    else:
+        purge_views()
+        flash('已清除全部缓存', 'success')
+    return redirect(url_for('admin.cache_stats'))
+
+
 @admin.route('/nginx_logs')
 @login_required
 def view_nginx_logs():
@@ -886,6 +1028,7 @@ def siteshare_new():
             return render_template('admin/edit_siteshare.html', site=None)
         site = SiteShare(name=name, url=url, is_visible=is_visible, is_pinned=is_pinned)
         site.save()
+        invalidate_tags('siteshare')
         flash('好站已添加', 'success')
         return redirect(url_for('admin.siteshare_list'))
     return render_template('admin/edit_siteshare.html', site=None)
@@ -904,6 +1047,7 @@ def siteshare_edit(site_id):
             flash('名称和链接不能为空', 'danger')
             return render_template('admin/edit_siteshare.html', site=site)
         site.save()
+        invalidate_tags('siteshare')
         flash('好站已更新', 'success')
         return redirect(url_for('admin.siteshare_list'))
     return render_template('admin/edit_siteshare.html', site=site)
@@ -914,6 +1058,7 @@ def siteshare_edit(site_id):
 def siteshare_delete(site_id):
     site = SiteShare.objects(id=site_id).first_or_404()
     site.delete()
+    invalidate_tags('siteshare')
     flash('好站已删除', 'success')
     return redirect(url_for('admin.siteshare_list'))
 
@@ -924,6 +1069,7 @@ def siteshare_toggle_pin(site_id):
     site = SiteShare.objects(id=site_id).first_or_404()
     site.is_pinned = not site.is_pinned
     site.save()
+    invalidate_tags('siteshare')
     return redirect(url_for('admin.siteshare_list'))
 
 
@@ -933,6 +1079,7 @@ def siteshare_toggle_visible(site_id):
     site = SiteShare.objects(id=site_id).first_or_404()
     site.is_visible = not site.is_visible
     site.save()
+    invalidate_tags('siteshare')
     return redirect(url_for('admin.siteshare_list'))
 
 
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+命令行工具模块
+注册 flask 命令，用于数据维护，例如：
+
+    flask --app run render-markdown
+    flask --app run check-indexes
+    flask --app run rebuild-search-index
+    flask --app run rebuild-excerpts
+    flask --app run reconcile-counters
+    flask --app run rebuild-attachments
+    flask --app run dedup-uploads
+    flask --app run sweep-uploads
+"""
+
+import os
+import shutil
+import time
+from collections import defaultdict
+
+import click
+from datetime import datetime
+from bson import ObjectId
+from .models import Post, Message, IPRecord, SearchTerm, Attachment, Blob
+from .utils.cache import invalidate_tags
+from .utils.pagination import POST_LIST_ORDER, TITLE_FILTER_HINT, order_posts
+from .utils.render import render_post_markdown, make_excerpt, excerpt_length, rebuild_excerpts
+from .utils.search import index_post
+from .utils import counters
+from .utils.file import (
+    ensure_upload_folder,
+    file_sha256,
+    blob_filename,
+    remove_released_file,
+    UPLOAD_TEMP_PREFIX,
+)
+
+# explain 结果中出现即视为索引缺失的阶段：全表扫描和内存排序
+BAD_STAGES = {'COLLSCAN', 'SORT'}
+
+
+def _query_shapes():
+    """
+    需要索引支持的查询，与 main/routes.py 和 admin/routes.py 中的查询保持一致
+
+    Returns:
+        list: (名称, QuerySet) 列表，条件中的值只用于生成执行计划
+    """
+    sample_id = ObjectId()
+    visible = Post.objects(is_visible=True)
+    # 游标分页的条件由一篇虚拟文章生成
+    cursor = (False, datetime(2000, 1, 1), datetime(2000, 1, 1), sample_id)
+    return [
+        ('首页文章列表', visible.order_by(*POST_LIST_ORDER)),
+        ('首页游标分页', order_posts(visible, cursor)),
+        ('首页分类筛选', Post.objects(is_visible=True, categories=sample_id).order_by(*POST_LIST_ORDER)),
+        ('搜索词项', SearchTerm.objects(term__in=['搜索', 'search'])),
+        ('搜索结果筛选', Post.objects(id__in=[sample_id], is_visible=True).order_by()),
+        ('后台文章列表', Post.objects.order_by(*POST_LIST_ORDER)),
+        ('后台按分类筛选', Post.objects(categories=sample_id).order_by(*POST_LIST_ORDER)),
+        ('后台按可见性筛选', Post.objects(is_visible=False).order_by(*POST_LIST_ORDER)),
+        (
+            '后台按标题筛选',
+            Post.objects(title__startswith='x').hint(TITLE_FILTER_HINT).order_by(*POST_LIST_ORDER),
+        ),
+        ('附件下载', Attachment.objects(filename='x')),
+        ('文章附件记录', Attachment.objects(post=sample_id)),
+        ('留言墙', Message.objects(is_public=True)),
+        ('清理上传文件', Message.objects(attachment__stored_filename__in=['x'])),
+        ('清理上传文件核对文章', Post.objects(attachments__stored_filename__in=['x'])),
+        ('后台留言列表', Message.objects.order_by('-created_at')),
+        ('后台 IP 记录列表', IPRecord.objects.order_by('-last_message_at')),
+        ('留言 IP 查询', IPRecord.objects(ip_address='127.0.0.1')),
+    ]
+
+
+def _plan_stages(plan):
+    """递归收集执行计划中的所有阶段名"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+def _unreferenced_uploads(names, md_names):
+    """
+    找出一批存储文件名中没有被文章附件、留言附件和 Markdown 源文件引用的文件
+
+    Args:
+        names (list): 存储文件名
+        md_names (set): Markdown 源文件的文件名
+    Returns:
+        list: 未被引用的文件名
+    """
+    referenced = set(md_names.intersection(names))
+    referenced.update(Attachment.objects(filename__in=names).scalar('filename'))
+    referenced.update(
+        attachment.get('stored_filename')
+        for attachment in Message.objects(attachment__stored_filename__in=names).scalar(
+            'attachment'
+        )
+    )
+    candidates = [name for name in names if name not in referenced]
+    if candidates:
+        # 附件记录同步失败时可能缺少记录，删除前再核对一次文章的附件列表
+        for attachments in Post.objects(attachments__stored_filename__in=candidates).scalar(
+            'attachments'
+        ):
+            referenced.update(item.get('stored_filename') for item in attachments)
+    return [name for name in candidates if name not in referenced]
+
+
+def register_commands(app):
+    """注册所有命令行工具"""
+
+    @app.cli.command('render-markdown')
+    @click.option('--force', is_flag=True, help='忽略源文件哈希，重新渲染全部文章')
+    def render_markdown_command(force):
+        """预渲染所有 Markdown 文章"""
+        rendered = skipped = failed = 0
+        length = excerpt_length()
+        for post in Post.objects(is_markdown=True):
+            try:
+                if render_post_markdown(post, force=force):
+                    Post.objects(id=post.id).update_one(
+                        set__rendered_html=post.rendered_html,
+                        set__rendered_toc=post.rendered_toc,
+                        set__source_hash=post.source_hash,
+                        set__excerpt=make_excerpt(post, length),
+                    )
+                    invalidate_tags(f'post:{post.id}', 'post-list')
+                    rendered += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                failed += 1
+                click.echo(f'渲染失败: {post.title} ({post.id}): {e}', err=True)
+        click.echo(f'已渲染 {rendered} 篇，未变化 {skipped} 篇，失败 {failed} 篇')
+
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        """创建索引并检查主要查询的执行计划，出现全表扫描或内存排序时失败"""
+        for model in (Post, Attachment, Message, IPRecord, SearchTerm):
+            model.ensure_indexes()
+        failed = 0
+        for name, queryset in _query_shapes():
+            plan = queryset.explain()['queryPlanner']['winningPlan']
+            stages = _plan_stages(plan)
+            bad = sorted(BAD_STAGES.intersection(stages))
+            if bad:
+                failed += 1
+            status = '失败' if bad else '通过'
+            click.echo(f'[{status}] {name}: {" -> ".join(reversed(stages))}')
+        if failed:
+            raise click.ClickException(f'{failed} 个查询没有使用合适的索引')
+        click.echo('所有查询均使用索引')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """重建全部文章的搜索索引"""
+        # 逐篇替换索引行，重建期间其他文章仍然可以搜索到
+        indexed = failed = 0
+        for post in Post.objects.order_by():
+            try:
+                index_post(post)
+                indexed += 1
+            except Exception as e:
+                failed += 1
+                click.echo(f'建立索引失败: {post.title} ({post.id}): {e}', err=True)
+        # 最后删除已不存在的文章留下的索引行
+        post_ids = set(SearchTerm.objects.distinct('post'))
+        stale = post_ids - set(Post.objects(id__in=list(post_ids)).scalar('id'))
+        if stale:
+            SearchTerm.objects(post__in=list(stale)).delete()
+        invalidate_tags('post-list')
+        click.echo(f'已为 {indexed} 篇文章建立索引，失败 {failed} 篇，清理 {len(stale)} 篇已删除文章的索引')
+
+    @app.cli.command('rebuild-excerpts')
+    def rebuild_excerpts_command():
+        """重新生成全部文章的列表摘要"""
+        updated = rebuild_excerpts()
+        invalidate_tags('post-list')
+        click.echo(f'已更新 {updated} 篇文章的摘要')
+
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters_command():
+        """从数据库重新统计分页使用的计数器"""
+        for name, value in sorted(counters.reconcile().items()):
+            click.echo(f'{name} = {value}')
+
+    @app.cli.command('rebuild-attachments')
+    def rebuild_attachments_command():
+        """根据文章的附件列表重建附件记录"""
+        Attachment.objects.delete()
+        synced = failed = 0
+        for post in Post.objects(attachments__ne=[]).only('attachments', 'created_at').order_by():
+            try:
+                # 旧附件没有上传时间，以文章创建时间代替
+                Attachment.sync_post(post, upload_time=post.created_at)
+                synced += 1
+            except Exception as e:
+                failed += 1
+                click.echo(f'同步附件失败: {post.id}: {e}', err=True)
+        click.echo(f'已同步 {synced} 篇文章的附件，共 {Attachment.objects.count()} 个，失败 {failed} 篇')
+
+    @app.cli.command('dedup-uploads')
+    @click.option('--dry-run', is_flag=True, help='只统计，不修改文件和数据库')
+    def dedup_uploads_command(dry_run):
+        """
+        把附件文件改为按内容命名，合并重复文件并重建引用计数
+
+        引用计数按扫描结果直接覆盖，扫描期间的上传和删除会被覆盖，
+        必须在停止写入（不发布、编辑文章，不提交、删除留言）的维护窗口中执行。
+        """
+        upload_folder = ensure_upload_folder()
+        renamed = {}  # 原存储文件名 -> 新存储文件名，文件不存在时为 None
+        blobs = {}  # 新存储文件名 -> (SHA-256, 大小)
+        refs = defaultdict(int)
+
+        def retarget(item):
+            """把一条附件信息指向按内容命名的文件，返回是否有变化"""
+            name = item.get('stored_filename')
+            if not name:
+                return False
+            if name not in renamed:
+                path = upload_folder / name if os.path.basename(name) == name else None
+                if path is None or not path.is_file():
+                    click.echo(f'附件文件不存在: {name}', err=True)
+                    renamed[name] = None
+                else:
+                    sha256 = file_sha256(path)
+                    renamed[name] = blob_filename(sha256, os.path.splitext(name)[1])
+                    blobs[renamed[name]] = (sha256, path.stat().st_size)
+            new_name = renamed[name]
+            if new_name is None:
+                return False
+            refs[new_name] += 1
+            sha256 = blobs[new_name][0]
+            if item['stored_filename'] == new_name and item.get('sha256') == sha256:
+                return False
+            item['stored_filename'] = new_name
+            item['sha256'] = sha256
+            return True
+
+        posts = []
+        for post in Post.objects(attachments__ne=[]).only('attachments').order_by():
+            # 用列表而不是生成器，保证每个附件都被处理
+            if any([retarget(item) for item in post.attachments]):
+                posts.append(post)
+        messages = [
+            message
+            for message in Message.objects(attachment__ne=None).only('attachment').order_by()
+            if retarget(message.attachment)
+        ]
+        renamed = {old: new for old, new in renamed.items() if new and new != old}
+
+        # 先建立按内容命名的文件（硬链接，不支持时复制），再修改引用，最后删除原文件，
+        # 中途失败时数据库引用的文件始终存在，可以重新执行
+        created = set()
+        for old, new_name in renamed.items():
+            if new_name in created or (upload_folder / new_name).exists():
+                continue
+            created.add(new_name)
+            if not dry_run:
+                try:
+                    os.link(upload_folder / old, upload_folder / new_name)
+                except OSError:
+                    shutil.copy2(upload_folder / old, upload_folder / new_name)
+
+        if not dry_run:
+            for post in posts:
+                Post.objects(id=post.id).update_one(set__attachments=post.attachments)
+                Attachment.sync_post(post)
+            for message in messages:
+                Message.objects(id=message.id).update_one(set__attachment=message.attachment)
+            # 文章详情和列表缓存中的附件链接指向旧文件名，旧文件删除前先让缓存失效
+            tags = [f'post:{post.id}' for post in posts]
+            if posts:
+                tags.append('post-list')
+            if messages:
+                tags.append('message-wall')
+            if tags:
+                invalidate_tags(*tags)
+            for name, count in refs.items():
+                sha256, size = blobs[name]
+                Blob.objects(stored_filename=name).update_one(
+                    upsert=True,
+                    set__refs=count,
+                    set_on_insert__sha256=sha256,
+                    set_on_insert__size=size,
+                )
+            Blob.objects(stored_filename__nin=list(refs)).delete()
+            for old in renamed:
+                try:
+                    os.remove(upload_folder / old)
+                except FileNotFoundError:
+                    pass
+
+        freed = sum(blobs[new][1] for new in renamed.values()) - sum(
+            blobs[name][1] for name in created
+        )
+        prefix = '[预演] ' if dry_run else ''
+        click.echo(
+            f'{prefix}更新 {len(posts)} 篇文章和 {len(messages)} 条留言的附件，'
+            f'{len(renamed)} 个文件合并为 {len(created)} 个新文件，'
+            f'共 {len(refs)} 个存储文件，释放 {freed / 1024 / 1024:.1f} MB'
+        )
+
+    @app.cli.command('sweep-uploads')
+    @click.option('--dry-run', is_flag=True, help='只列出将要删除的文件')
+    @click.option('--grace-hours', type=float, default=None, help='只清理早于多少小时的文件')
+    @click.option('--batch-size', type=int, default=500, show_default=True, help='每批核对的文件数')
+    def sweep_uploads_command(dry_run, grace_hours, batch_size):
+        """删除 uploads 目录中没有被文章、留言引用的文件"""
+        if grace_hours is None:
+            grace_hours = app.config.get('UPLOAD_SWEEP_GRACE_HOURS', 24)
+        upload_folder = ensure_upload_folder()
+        cutoff = time.time() - grace_hours * 3600
+        # Markdown 文章数量不多，源文件名一次读出；数据库中保存的是绝对路径，只比较文件名
+        md_names = {
+            os.path.basename(path)
+            for path in Post.objects(md_file_path__ne=None).scalar('md_file_path')
+            if path
+        }
+        stats = defaultdict(int)
+
+        def sweep(batch):
+            orphans = _unreferenced_uploads(batch, md_names)
+            refs = {
+                blob.stored_filename: blob.refs
+                for blob in Blob.objects(stored_filename__in=orphans).only(
+                    'stored_filename', 'refs'
+                )
+            }
+            for name in orphans:
+                path = upload_folder / name
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                # 扫描之后文件可能被同内容的新上传覆盖，或存储记录的引用数有变化
+                if stat.st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    if (
+                        name in refs
+                        and not Blob.objects(stored_filename=name, refs=refs[name]).delete()
+                    ):
+                        continue
+                    if not remove_released_file(path):
+                        continue
+                stats['deleted'] += 1
+                stats['bytes'] += stat.st_size
+                click.echo(f'{"[预演] 将删除" if dry_run else "已删除"}: {name} ({stat.st_size} 字节)')
+
+        batch = []
+        with os.scandir(upload_folder) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # 隐藏文件中只处理上传中断留下的临时文件
+                if entry.name.startswith('.') and not entry.name.startswith(UPLOAD_TEMP_PREFIX):
+                    continue
+                stats['scanned'] += 1
+                if entry.stat().st_mtime >= cutoff:
+                    stats['recent'] += 1
+                    continue
+                batch.append(entry.name)
+                if len(batch) >= batch_size:
+                    sweep(batch)
+                    batch = []
+        if batch:
+            sweep(batch)
+
+        prefix = '[预演] ' if dry_run else ''
+        click.echo(
+            f'{prefix}扫描 {stats["scanned"]} 个文件，{stats["recent"]} 个在保留期内，'
+            f'删除 {stats["deleted"]} 个未引用文件，释放 {stats["bytes"] / 1024 / 1024:.1f} MB'
+        )
@@ -1,11 +1,12 @@
-from .models import SiteConfig
+from .models import SiteConfig, Category
 
 
 def site_config():
     """
     提供网站配置给模板
     """
-    configs = {}
-    for config in SiteConfig.objects.all():
-        configs[config.key] = config.value
-    return {'site_config': configs}
+    return {
+        'site_config': SiteConfig.get_configs(),
+        # 列表查询使用 no_dereference()，模板通过进程内分类快照解析分类
+        'resolve_categories': Category.resolve,
+    }
@@ -10,104 +10,75 @@ from flask import (
     url_for,
     flash,
     request,
-    send_file,
     current_app,
-    send_from_directory,
     abort,
     jsonify,
+    session,
 )
+from flask_mongoengine.pagination import Pagination
 from . import main
-from ..models import Post, SiteConfig, Message, IPRecord, Category, SiteShare
+from ..models import (
+    Post,
+    SiteConfig,
+    Message,
+    IPRecord,
+    Category,
+    SiteShare,
+    Attachment,
+    get_utc_time,
+)
 from ..utils.security import (
     sanitize_string,
     sanitize_mongo_query,
     validate_object_id,
-    escape_regex_pattern,
 )
-from ..utils.cache import cache_for
-import os
-from pathlib import Path
-import json
+from ..utils.cache import cache_for, int_param
+from ..utils.render import render_post_markdown, make_excerpt, html_to_text
+from ..utils.search import search_post_ids, highlight
+from ..utils import counters
+from ..utils.file import (
+    ensure_upload_folder,
+    save_file,
+    send_attachment,
+    acquire_file,
+    release_file,
+)
+from ..utils.pagination import (
+    POST_LIST_ORDER,
+    CursorPage,
+    NumberedPage,
+    decode_post_cursor,
+    encode_post_cursor,
+    normalize_post_cursor,
+)
 from flask_login import current_user
-import uuid
-from werkzeug.utils import secure_filename
+import random
+from mongoengine.errors import NotUniqueError
 from app.constants import VERSION
 
 
-def ensure_upload_folder():
-    """确保上传文件夹存在并返回正确的路径"""
-    try:
-        # 获取项目根目录（app的父目录）
-        base_dir = Path(current_app.root_path).parent
-        # 创建uploads目录
-        upload_folder = base_dir / 'uploads'
-        upload_folder.mkdir(parents=True, exist_ok=True)
-
-        # 设置上传文件夹路径到应用配置中
-        current_app.config['UPLOAD_FOLDER'] = str(upload_folder)
-
-        # 确保目录存在且可写
-        if not upload_folder.exists():
-            raise Exception("Upload folder does not exist after creation attempt")
-        if not os.access(str(upload_folder), os.W_OK):
-            raise Exception("Upload folder is not writable")
-
-        return upload_folder
-    except Exception as e:
-        current_app.logger.error(f"Error ensuring upload folder: {str(e)}")
-        raise
-
-
-def save_file(file):
-    """
-    保存上传的文件
+# 会话中保存留言预览上传的附件信息的键
+PREVIEW_ATTACHMENT_KEY = 'message_attachment'
 
-    Args:
-        file: 文件对象
-
-    Returns:
-        dict: 包含保存结果的字典
-    """
-    try:
-        if not file:
-            return {'success': False, 'message': '没有文件'}
-
-        # 获取原始文件名和扩展名
-        original_filename = file.filename
-        filename = secure_filename(original_filename)
-        if not filename:
-            return {'success': False, 'message': '无效的文件名'}
-
-        # 生成唯一的文件名
-        ext = os.path.splitext(filename)[1]
-        stored_filename = f"{uuid.uuid4().hex}{ext}"
-
-        # 确保上传目录存在
-        upload_folder = ensure_upload_folder()
-
-        # 保存文件
-        file_path = upload_folder / stored_filename
-        file.save(str(file_path))
-
-        # 获取文件大小（KB）
-        file_size = round(os.path.getsize(str(file_path)) / 1024)
-
-        return {
-            'success': True,
-            'file_info': {
-                'filename': original_filename,  # 使用原始文件名
-                'stored_filename': stored_filename,
-                'file_type': file.content_type,
-                'file_size': file_size,
-            },
-        }
-    except Exception as e:
-        current_app.logger.error(f"保存文件失败: {str(e)}")
-        return {'success': False, 'message': str(e)}
+# 首页列表模板和游标分页用到的字段，列表查询只读取这些字段
+POST_LIST_FIELDS = ('title', 'categories', 'created_at', 'updated_at', 'is_pinned', 'excerpt')
+# 搜索结果还需要正文生成高亮摘要，Markdown 文章使用预渲染的 HTML
+SEARCH_FIELDS = ('content', 'rendered_html')
 
 
 @main.route('/')
-@cache_for(duration=300)  # 5分钟缓存
+@cache_for(
+    duration=6 * 3600,
+    hard_duration=24 * 3600,  # 6小时后返回旧页面并在后台刷新
+    tags=['post-list', 'category', 'site-config'],
+    etag=True,
+    key_params={
+        'page': int_param(1),
+        'after': normalize_post_cursor,
+        'search': str.strip,
+        'category': str.strip,
+    },
+)
 def index():
     """首页路由"""
     current_app.logger.info("访问首页")
@@ -118,42 +89,83 @@ def index():
 
     # 构建查询条件
     query = {'is_visible': True}
-    if search_query:
-        current_app.logger.info(f"搜索文章，关键词: {search_query}")
-        pattern = escape_regex_pattern(search_query)
-        query['title'] = {'$regex': pattern, '$options': 'i'}
     if category_id:
         query['categories'] = category_id
 
     # 使用清理后的查询条件
     safe_query = sanitize_mongo_query(query)
-    current_app.logger.info(f"查询文章列表，页码: {page}, 每页数量: {per_page}")
-    posts = (
-        Post.objects(**safe_query)
-        .order_by('-is_pinned', '-updated_at', '-created_at')
-        .paginate(page=page, per_page=per_page)
-    )
-
-    # 获取所有网站配置
-    current_app.logger.info("获取网站配置")
-    site_configs = {}
-    for config in SiteConfig.objects:
-        site_configs[config.key] = config.value
-
+    numbered_pages = current_app.config.get('POST_LIST_NUMBERED_PAGES', 5)
     # 获取所有分类
-    categories = Category.objects.order_by('-created_at')
+    categories = Category.get_all()
+    next_cursor = None
+    highlights = {}
+    # 带 after 游标时从游标位置往后取一页，不统计总数也不跳过前面的文章
+    cursor = decode_post_cursor(request.args.get('after'))
+    if search_query:
+        current_app.logger.info(f"搜索文章，关键词: {search_query}")
+        # 搜索结果按相关度排序且有数量上限，全部使用页码分页
+        ranked = search_post_ids(search_query)
+        matched = set(Post.objects(id__in=ranked, **safe_query).order_by().scalar('id'))
+        posts = Pagination([post_id for post_id in ranked if post_id in matched], page, per_page)
+        found = (
+            Post.objects.only(*POST_LIST_FIELDS, *SEARCH_FIELDS)
+            .no_dereference()
+            .in_bulk(posts.items)
+        )
+        posts.items = [found[post_id] for post_id in posts.items if post_id in found]
+        numbered_pages = posts.pages
+        preview_length = int(SiteConfig.get_config('content_preview_length', 200))
+        highlights = {
+            post.id: (
+                highlight(post.title, search_query),
+                highlight(
+                    html_to_text(post.rendered_html or post.content), search_query, preview_length
+                ),
+            )
+            for post in posts.items
+        }
+    elif cursor:
+        current_app.logger.info(f"按游标查询文章列表，每页数量: {per_page}")
+        posts = CursorPage(
+            Post.objects(**safe_query).only(*POST_LIST_FIELDS).no_dereference(), cursor, per_page
+        )
+        next_cursor = posts.next_cursor
+    else:
+        current_app.logger.info(f"查询文章列表，页码: {page}, 每页数量: {per_page}")
+        # 只有前几页使用页码分页，更深的页面通过游标访问，不再用 skip() 跳过前面的文章
+        if page > numbered_pages:
+            abort(404)
+        queryset = Post.objects(**safe_query)
+        # 总数读取计数器；分类不存在时没有对应的计数器，直接统计
+        if not category_id:
+            total = counters.get(counters.VISIBLE_POSTS, queryset.count)
+        elif category_id in {str(category.id) for category in categories}:
+            total = counters.get(counters.category_counter(category_id), queryset.count)
+        else:
+            total = None
+        posts = NumberedPage(
+            queryset.only(*POST_LIST_FIELDS).no_dereference().order_by(*POST_LIST_ORDER),
+            page,
+            per_page,
+            total=total,
+        )
+        # 页码分页的最后一页之后改用游标
+        if posts.page >= numbered_pages and posts.has_next:
+            next_cursor = encode_post_cursor(posts.items[-1])
 
     return render_template(
         'main/index.html',
         posts=posts,
-        site_config=site_configs,
         categories=categories,
         selected_category=category_id,
+        next_cursor=next_cursor,
+        numbered_pages=numbered_pages,
+        highlights=highlights,
     )
 
 
 @main.route('/siteshare')
-@cache_for(duration=600)  # 10分钟缓存
+@cache_for(duration=6 * 3600, tags=['siteshare', 'site-config'], etag=True, key_params={})
 def siteshare():
     """好站分享页面"""
     current_app.logger.info("访问好站分享页面")
@@ -162,7 +174,7 @@ def siteshare():
 
 
 @main.route('/about')
-@cache_for(duration=600)  # 10分钟缓存
+@cache_for(duration=6 * 3600, tags=['site-config'], etag=True, key_params={})
 def about():
     """关于作者页面"""
     current_app.logger.info("访问关于作者页面")
@@ -182,40 +194,21 @@ def download_attachment(filename):
             flash('无效的文件名', 'error')
             return redirect(url_for('main.index'))
 
-        # 查找包含此附件的文章
-        query = {'attachments__stored_filename': safe_filename, 'is_visible': True}
-        safe_query = sanitize_mongo_query(query)
-        current_app.logger.info(f"查找包含附件的文章: {safe_filename}")
-        post = Post.objects(**safe_query).first()
-
-        if not post:
-            current_app.logger.warning(f"未找到包含附件的文章: {safe_filename}")
-            flash('文件不存在或已被删除', 'error')
-            return redirect(url_for('main.index'))
-
-        # 获取原始文件名
-        attachment = next(
-            (a for a in post.attachments if a['stored_filename'] == safe_filename), None
-        )
+        # 按存储文件名查找附件记录，只允许下载可见文章的附件
+        current_app.logger.info(f"查找附件记录: {safe_filename}")
+        attachment = Attachment.find(safe_filename, visible_only=True)
         if not attachment:
-            current_app.logger.warning(f"文章中未找到附件记录: {safe_filename}")
+            current_app.logger.warning(f"未找到可见文章中的附件: {safe_filename}")
             flash('文件不存在或已被删除', 'error')
             return redirect(url_for('main.index'))
 
-        # 使用项目根目录下的 uploads 文件夹
-        base_dir = Path(current_app.root_path).parent
-        upload_folder = base_dir / 'uploads'
-        file_path = upload_folder / safe_filename
-
-        if file_path.exists():
-            current_app.logger.info(f"开始发送文件: {attachment['filename']}")
-            return send_file(
-                str(file_path), download_name=attachment['filename'], as_attachment=True
-            )
-        else:
-            current_app.logger.warning(f"文件不存在: {file_path}")
+        response = send_attachment(safe_filename, attachment.original_filename)
+        if response is None:
+            current_app.logger.warning(f"文件不存在: {safe_filename}")
             flash('文件不存在或已被删除', 'error')
             return redirect(url_for('main.index'))
+        current_app.logger.info(f"开始发送文件: {attachment.original_filename}")
+        return response
     except Exception as e:
         current_app.logger.error(f"下载文件时发生错误: {str(e)}")
         flash('下载文件时发生错误', 'error')
@@ -225,12 +218,8 @@ def download_attachment(filename):
 @main.route('/message')
 def message():
     """留言页面"""
-    # 获取所有网站配置
-    site_config = SiteConfig.get_configs()
-    # 添加留言相关的配置
-    message_config = SiteConfig.get_message_configs()
-    site_config.update(message_config)
-    return render_template('main/message.html', site_config=site_config)
+    # 网站配置（包含留言相关配置）由上下文处理器从进程内快照提供
+    return render_template('main/message.html')
 
 
 @main.route('/message/preview', methods=['POST'])
@@ -251,12 +240,15 @@ def preview_message():
     if 'attachment' in request.files:
         file = request.files['attachment']
         if file and file.filename:
-            result = save_file(file)
-            if result['success']:
-                attachment = result['file_info']
-            else:
-                flash(f'附件上传失败：{result["message"]}', 'danger')
+            # 预览时不占用引用，提交时由留言占用
+            file_info = save_file(file, acquire=False)
+            if not file_info:
+                flash('附件上传失败，请重试', 'danger')
                 return redirect(url_for('main.message'))
+            # 提交时以会话中保存的附件信息为准，表单中的附件信息只用于显示
+            session[PREVIEW_ATTACHMENT_KEY] = file_info
+            # 留言附件的大小以 KB 保存
+            attachment = dict(file_info, file_size=round(file_info['file_size'] / 1024))
 
     message = {
         'content': content,
@@ -275,7 +267,7 @@ def submit_message():
     contact = request.form.get('contact', '').strip()
     allow_public = request.form.get('allow_public', 'false') == 'true'
     is_public = False
-    attachment_json = request.form.get('attachment')
+    attachment_name = request.form.get('attachment')
 
     # 检查内容长度
     site_config = SiteConfig.get_message_configs()
@@ -332,20 +324,6 @@ def submit_message():
     # 获取IP地址
     ip_address = get_real_ip()
 
-    # 检查IP是否被限制
-    ip_record = IPRecord.objects(ip_address=ip_address).first()
-    if ip_record and ip_record.is_blocked:
-        flash('网站作者不允许你说话，找他问问为什么吧', 'danger')
-        return redirect(url_for('main.message'))
-
-    # 检查留言数量限制
-    if ip_record:
-        if ip_record.message_count >= site_config['max_messages_per_ip']:
-            flash(f'每个人最多只能发送{site_config["max_messages_per_ip"]}条留言', 'danger')
-            return redirect(url_for('main.message'))
-    else:
-        ip_record = IPRecord(ip_address=ip_address)
-
     # 创建留言
     message = Message(
         content=content,
@@ -353,38 +331,65 @@ def submit_message():
         allow_public=allow_public,
         ip_address=ip_address,
         is_public=is_public,
+        created_at=get_utc_time(),
     )
 
-    # 处理附件
-    if attachment_json:
-        try:
-            # 记录接收到的附件信息用于调试
-            current_app.logger.debug(f"接收到的附件信息: {attachment_json}")
-
-            # 如果附件信息是字符串，尝试解析为 JSON
-            if isinstance(attachment_json, str):
-                attachment = json.loads(attachment_json)
-            else:
-                attachment = attachment_json
-
-            # 验证附件信息的完整性
-            required_fields = ['filename', 'stored_filename', 'file_type', 'file_size']
-            if all(field in attachment for field in required_fields):
-                message.attachment = attachment
-            else:
-                raise ValueError("附件信息不完整")
-
-        except (json.JSONDecodeError, ValueError) as e:
-            current_app.logger.error(f"处理附件信息时出错: {str(e)}")
-            flash('附件信息无效', 'danger')
+    # 处理附件：表单中只有存储文件名，只接受本会话预览时上传的文件，附件信息取自会话
+    attachment = None
+    if attachment_name:
+        pending = session.pop(PREVIEW_ATTACHMENT_KEY, None)
+        if (
+            not pending
+            or attachment_name != pending['stored_filename']
+            or not (ensure_upload_folder() / attachment_name).is_file()
+        ):
+            current_app.logger.warning(f"留言附件与预览记录不符: {attachment_name}")
+            flash('附件信息无效，请重新上传', 'danger')
             return redirect(url_for('main.message'))
+        attachment = pending
+        # 留言附件的大小以 KB 保存
+        message.attachment = dict(pending, file_size=round(pending['file_size'] / 1024))
+
+    # 检查IP限制并占用一条留言额度，条件判断和计数在一次原子操作中完成，
+    # 并发提交也不会超过上限。IP 记录不存在时插入新记录；记录存在但被禁止或
+    # 已达上限时条件不匹配，upsert 与 ip_address 唯一索引冲突
+    max_messages = site_config['max_messages_per_ip']
+    accepted = max_messages > 0
+    if accepted:
+        try:
+            previous = IPRecord.objects(
+                ip_address=ip_address, message_count__lt=max_messages, is_blocked__ne=True
+            ).modify(
+                upsert=True,
+                new=False,
+                inc__message_count=1,
+                set__last_message_at=message.created_at,
+            )
+        except NotUniqueError:
+            accepted = False
+    if not accepted:
+        # 只有被拒绝时才再读一次，区分被禁止和达到上限
+        ip_record = IPRecord.objects(ip_address=ip_address).only('is_blocked').first()
+        if ip_record and ip_record.is_blocked:
+            flash('网站作者不允许你说话，找他问问为什么吧', 'danger')
+        else:
+            flash(f'每个人最多只能发送{max_messages}条留言', 'danger')
+        return redirect(url_for('main.message'))
 
-    message.save()
-
-    # 更新IP记录
-    ip_record.message_count += 1
-    ip_record.last_message_at = message.created_at
-    ip_record.save()
+    # 每条留言占用自己的附件引用，删除留言时释放
+    if attachment:
+        acquire_file(attachment['stored_filename'], attachment['sha256'], attachment['file_size'])
+    try:
+        message.save()
+    except Exception:
+        # 留言保存失败时归还额度和附件引用
+        IPRecord.objects(ip_address=ip_address).update_one(dec__message_count=1)
+        if attachment:
+            release_file(attachment['stored_filename'])
+        raise
+    counters.incr(counters.MESSAGES)
+    if previous is None:
+        counters.incr(counters.IP_RECORDS)
 
     flash('留言提交成功', 'success')
     return redirect(url_for('main.message'))
@@ -403,16 +408,28 @@ def download_message_attachment(message_id):
     if not message.is_public and not current_user.is_authenticated:
         abort(403)
 
-    return send_from_directory(
-        current_app.config['UPLOAD_FOLDER'],
-        message.attachment['stored_filename'],
-        as_attachment=True,
-        download_name=message.attachment['filename'],
+    response = send_attachment(
+        message.attachment.get('stored_filename'), message.attachment.get('filename')
     )
+    if response is None:
+        abort(404)
+    return response
 
 
 @main.route('/post/<post_id>')
-@cache_for(duration=300)  # 5分钟缓存
+@cache_for(
+    duration=6 * 3600,
+    hard_duration=24 * 3600,  # 6小时后返回旧页面并在后台刷新
+    tags=lambda post_id: [f'post:{post_id}', 'category', 'site-config'],
+    etag=True,
+    # 详情页的返回链接使用这些参数
+    key_params={
+        'from_page': int_param(1),
+        'from_after': normalize_post_cursor,
+        'search': str.strip,
+        'category': str.strip,
+    },
+)
 def post(post_id):
     """文章详情页"""
     # 验证并清理 post_id
@@ -421,17 +438,25 @@ def post(post_id):
         flash('无效的文章ID', 'danger')
         return redirect(url_for('main.index'))
     # 查询文章
-    post = Post.objects(id=post_id, is_visible=True).first_or_404()
+    post = Post.objects(id=post_id, is_visible=True).no_dereference().first_or_404()
     html_content = post.content
     if getattr(post, 'is_markdown', False) and getattr(post, 'md_file_path', None):
-        try:
-            import markdown
-
-            with open(post.md_file_path, 'r', encoding='utf-8') as f:
-                md_text = f.read()
-            html_content = markdown.markdown(md_text, extensions=['extra', 'codehilite', 'toc'])
-        except Exception as e:
-            html_content = f'<div class="alert alert-danger">Markdown 渲染失败: {e}</div>'
+        if post.source_hash and post.rendered_html is not None:
+            # 使用保存文章时预渲染的 HTML
+            html_content = post.rendered_html
+        else:
+            # 旧文章没有预渲染结果，渲染一次并保存
+            try:
+                render_post_markdown(post)
+                Post.objects(id=post.id).update_one(
+                    set__rendered_html=post.rendered_html,
+                    set__rendered_toc=post.rendered_toc,
+                    set__source_hash=post.source_hash,
+                    set__excerpt=make_excerpt(post),
+                )
+                html_content = post.rendered_html
+            except Exception as e:
+                html_content = f'<div class="alert alert-danger">Markdown 渲染失败: {e}</div>'
     else:
         # 普通文章内容自动转超链接
         import re
@@ -447,17 +472,9 @@ def post(post_id):
 @main.route('/messages')
 def messages_show():
     """留言墙页面"""
-    # 获取最多20条公开的留言，使用 MongoDB 的聚合管理实现随机排序
-    pipeline = [
-        {'$match': {'is_public': True}},  # 筛选公开留言
-        {'$sample': {'size': 20}},  # 随机选择20条
-    ]
-    messages = list(Message.objects.aggregate(pipeline))
-
-    # 转换为字典列表，以便JSON序列化
-    messages_list = [
-        {'content': msg['content'], 'contact': msg.get('contact', '匿名')} for msg in messages
-    ]
+    # 从进程内候选池中随机选择最多20条公开留言，候选池变化前不查询数据库
+    pool = Message.get_wall_pool()
+    messages_list = random.sample(pool, min(20, len(pool)))
 
     return render_template('main/messages_show.html', messages=messages_list)
 
@@ -53,6 +53,45 @@ def convert_to_local_time(utc_dt):
     return local_dt
 
 
+class TagSnapshot:
+    """
+    随缓存标签失效的进程内快照
+
+    快照只在标签的版本号变化时（后台修改相关数据后）重新从数据库加载，
+    其余情况下读取不产生数据库查询。
+    """
+
+    def __init__(self, tag, name):
+        """
+        Args:
+            tag (str): 缓存标签
+            name (str): 快照名称，用于日志
+        """
+        self.tag = tag
+        self.name = name
+        self._snapshot = None  # (标签版本号, 数据)
+
+    def get(self, load):
+        """
+        获取快照数据
+
+        Args:
+            load (callable): 从数据库加载数据的函数，标签版本号变化时调用
+        """
+        from .utils.cache import tag_versions
+
+        try:
+            tag_versions.sync()
+        except Exception as e:
+            current_app.logger.error(f"同步{self.name}版本失败: {str(e)}")
+        version = tag_versions.get(self.tag)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != version:
+            snapshot = (version, load())
+            self._snapshot = snapshot
+        return snapshot[1]
+
+
 class Admin(db.Document, UserMixin):
     """管理员模型，包含用户名和密码哈希。"""
 
@@ -74,6 +113,19 @@ class Admin(db.Document, UserMixin):
         return super(Admin, self).save(*args, **kwargs)
 
 
+class SearchTerm(db.Document):
+    """文章搜索的倒排索引，每篇文章的每个词项一行"""
+
+    term = db.StringField(required=True)  # 词项：中文二元组或单字、英文单词
+    post = db.ObjectIdField(required=True)  # 文章 ID
+    weight = db.FloatField(default=0)  # 词项在文章中的权重，标题中的词项加权
+
+    meta = {
+        'collection': 'search_index',
+        'indexes': [{'fields': ['term', 'post'], 'unique': True}, 'post'],
+    }
+
+
 class Category(db.Document):
     """分类模型。"""
 
@@ -83,6 +135,43 @@ class Category(db.Document):
 
     meta = {'collection': 'category', 'ordering': ['-created_at'], 'indexes': ['name']}
 
+    # 进程内分类快照：(按创建时间倒序的分类列表, {ID: 分类})
+    _snapshot = TagSnapshot('category', '分类')
+
+    @classmethod
+    def _get_snapshot(cls):
+        """
+        获取进程内分类快照
+
+        后台增删改分类后重新加载，列表页解析文章分类不再逐个查询引用。
+        """
+
+        def load():
+            categories = list(cls.objects.order_by('-created_at'))
+            return categories, {category.id: category for category in categories}
+
+        return cls._snapshot.get(load)
+
+    @classmethod
+    def get_all(cls):
+        """获取全部分类，按创建时间倒序"""
+        return list(cls._get_snapshot()[0])
+
+    @classmethod
+    def resolve(cls, refs):
+        """
+        将文章中的分类引用解析为分类对象
+
+        Args:
+            refs (list): 分类引用，可以是 DBRef、ObjectId 或 Category
+
+        Returns:
+            list: 分类对象，已删除的分类被忽略
+        """
+        categories = cls._get_snapshot()[1]
+        resolved = (categories.get(getattr(ref, 'id', ref)) for ref in refs or ())
+        return [category for category in resolved if category is not None]
+
     def __str__(self):
         return self.name
 
@@ -100,23 +189,91 @@ class Post(db.Document):
     attachments = db.ListField(db.DictField())
     is_markdown = db.BooleanField(default=False)
     md_file_path = db.StringField()
+    rendered_html = db.StringField()  # Markdown 预渲染的 HTML
+    rendered_toc = db.StringField()  # Markdown 预渲染的目录 HTML
+    source_hash = db.StringField()  # 渲染时 Markdown 源文件的 SHA-256
+    excerpt = db.StringField()  # 列表页显示的纯文本摘要，保存时生成
 
     meta = {
         'collection': 'post',
         'ordering': ['-is_pinned', '-updated_at', '-created_at'],
-        'indexes': ['title', 'categories', 'created_at', 'updated_at', 'is_visible', 'is_pinned'],
+        # 复合索引与 commands.py 中 check-indexes 检查的查询一一对应，
+        # 等值条件在前、排序字段在后，排序可以直接沿索引完成
+        'indexes': [
+            'title',
+            'created_at',
+            'updated_at',
+            # 首页列表的筛选和排序，游标分页沿此索引定位
+            ('is_visible', '-is_pinned', '-updated_at', '-created_at', '-id'),
+            # 首页按分类筛选
+            ('categories', 'is_visible', '-is_pinned', '-updated_at', '-created_at', '-id'),
+            # 后台文章列表，以及按分类筛选（不限可见性）；
+            # 末尾的 title 供后台按标题前缀筛选时在索引中判断条件
+            ('-is_pinned', '-updated_at', '-created_at', '-id', 'title'),
+            ('categories', '-is_pinned', '-updated_at', '-created_at', '-id'),
+            # sweep-uploads 在附件记录之外再核对文章的附件列表
+            'attachments.stored_filename',
+        ],
     }
 
+    # 这些字段变化时重新生成摘要和搜索索引
+    TEXT_FIELDS = {'title', 'content', 'is_markdown', 'md_file_path', 'rendered_html'}
+
     def save(self, *args, **kwargs):
-        """保存文章，自动更新时间。"""
+        """保存文章，自动更新时间，正文变化时更新摘要和搜索索引，附件变化时同步附件记录。"""
+        from .utils.render import make_excerpt
+
         if not self.created_at:
             self.created_at = get_utc_time()
         self.updated_at = get_utc_time()
-        return super(Post, self).save(*args, **kwargs)
+        text_changed = (
+            self.pk is None
+            or self.excerpt is None
+            or self.TEXT_FIELDS.intersection(self._get_changed_fields())
+        )
+        attachments_changed = self.pk is None or any(
+            field.split('.')[0] == 'attachments' for field in self._get_changed_fields()
+        )
+        if text_changed:
+            self.excerpt = make_excerpt(self)
+        result = super(Post, self).save(*args, **kwargs)
+        if text_changed:
+            self._update_search_index()
+        if attachments_changed:
+            self._sync_attachments()
+        return result
 
     def delete(self, *args, **kwargs):
         """删除文章。"""
-        return super(Post, self).delete(*args, **kwargs)
+        from .utils.search import remove_posts
+
+        post_id = self.id
+        result = super(Post, self).delete(*args, **kwargs)
+        try:
+            remove_posts([post_id])
+        except Exception as e:
+            current_app.logger.error(f"删除文章搜索索引失败: {post_id}, 错误: {str(e)}")
+        try:
+            Attachment.remove_posts([post_id])
+        except Exception as e:
+            current_app.logger.error(f"删除文章附件记录失败: {post_id}, 错误: {str(e)}")
+        return result
+
+    def _update_search_index(self):
+        """重建本文的搜索索引，失败时只记录日志，可用 rebuild-search-index 命令补建"""
+        from .utils.search import index_post
+
+        try:
+            index_post(self)
+        except Exception as e:
+            current_app.logger.error(f"更新文章搜索索引失败: {self.id}, 错误: {str(e)}")
+
+    def _sync_attachments(self):
+        """同步本文的附件记录，失败时只记录日志，可用 rebuild-attachments 命令补建"""
+        try:
+            Attachment.sync_post(self)
+        except Exception as e:
+            current_app.logger.error(f"同步文章附件记录失败: {self.id}, 错误: {str(e)}")
 
     @property
     def local_created_at(self):
@@ -130,16 +287,21 @@ class Post(db.Document):
 
 
 class Attachment(db.Document):
-    """附件模型"""
+    """
+    附件模型
+    文章附件的索引，由 Post.save 根据 Post.attachments 同步，
+    下载时按存储文件名一次查到所属文章和原始文件名，不再扫描文章集合
+    """
 
-    filename = db.StringField(required=True)
+    filename = db.StringField(required=True)  # 存储文件名
     original_filename = db.StringField(required=True)
-    file_path = db.StringField(required=True)
+    file_path = db.StringField(required=True)  # 相对上传目录的路径
     file_type = db.StringField()
     file_size = db.IntField()
     upload_time = db.DateTimeField(default=get_utc_time)
     post = db.ReferenceField('Post')
 
+    # 同一个文件可能被多篇文章引用，filename 不能建唯一索引
     meta = {'collection': 'attachment', 'indexes': ['filename', 'post', 'upload_time']}
 
     def save(self, *args, **kwargs):
@@ -152,12 +314,90 @@ class Attachment(db.Document):
         current_app.logger.info(f"删除附件: {self.original_filename}")
         return super(Attachment, self).delete(*args, **kwargs)
 
+    @classmethod
+    def sync_post(cls, post, upload_time=None):
+        """
+        按文章当前的附件列表重建附件记录
+
+        已有记录的上传时间保持不变。
+
+        Args:
+            post (Post): 已保存的文章
+            upload_time (datetime): 新记录的上传时间，默认为当前时间
+        """
+        upload_times = {
+            row['filename']: row.get('upload_time')
+            for row in cls.objects(post=post.id).only('filename', 'upload_time').as_pymongo()
+        }
+        upload_time = upload_time or get_utc_time()
+        rows = [
+            cls(
+                filename=item['stored_filename'],
+                original_filename=item.get('filename') or item['stored_filename'],
+                file_path=item['stored_filename'],
+                file_type=item.get('file_type'),
+                file_size=item.get('file_size'),
+                upload_time=upload_times.get(item['stored_filename']) or upload_time,
+                post=post.id,
+            )
+            for item in post.attachments or ()
+            if item.get('stored_filename')
+        ]
+        cls.objects(post=post.id).delete()
+        if rows:
+            cls.objects.insert(rows, load_bulk=False)
+
+    @classmethod
+    def remove_posts(cls, post_ids):
+        """删除文章的附件记录"""
+        cls.objects(post__in=list(post_ids)).delete()
+
+    @classmethod
+    def find(cls, filename, post_id=None, visible_only=False):
+        """
+        按存储文件名查找附件
+
+        Args:
+            filename (str): 存储文件名
+            post_id (ObjectId): 只查找这篇文章的附件
+            visible_only (bool): 是否只返回可见文章的附件
+
+        Returns:
+            Attachment: 附件记录，没有时返回 None
+        """
+        query = {'filename': filename}
+        if post_id is not None:
+            query['post'] = post_id
+        rows = list(cls.objects(**query).no_dereference())
+        if not visible_only or not rows:
+            return rows[0] if rows else None
+        post_ids = [getattr(row.post, 'id', row.post) for row in rows]
+        visible = set(Post.objects(id__in=post_ids, is_visible=True).order_by().scalar('id'))
+        return next((row for row in rows if getattr(row.post, 'id', row.post) in visible), None)
+
     @property
     def local_upload_time(self):
         """获取本地时区的上传时间"""
         return convert_to_local_time(self.upload_time)
 
 
+class Blob(db.Document):
+    """
+    上传文件的存储记录
+
+    附件按内容的 SHA-256 命名，相同内容只保存一份。refs 是引用该文件的文章附件和
+    留言附件的数量，降为 0 时删除文件。
+    """
+
+    stored_filename = db.StringField(required=True, unique=True)  # SHA-256 加扩展名
+    sha256 = db.StringField(required=True)
+    size = db.IntField()  # 字节数
+    refs = db.IntField(default=0)  # 引用数
+    created_at = db.DateTimeField(default=get_utc_time)
+
+    meta = {'collection': 'blobs', 'indexes': ['sha256']}
+
+
 class SiteConfig(db.Document):
     """网站配置模型"""
 
@@ -168,21 +408,28 @@ class SiteConfig(db.Document):
 
     meta = {'collection': 'site_config', 'indexes': ['key']}
 
+    # 进程内配置快照：{键名: 类型转换后的值}
+    _snapshot = TagSnapshot('site-config', '配置')
+
+    @classmethod
+    def _get_snapshot(cls):
+        """获取进程内配置快照，后台保存设置后重新加载"""
+        return cls._snapshot.get(
+            lambda: {config.key: config.get_typed_value() for config in cls.objects}
+        )
+
     @classmethod
     def get_config(cls, key, default=None):
         """获取配置项值"""
-        config = cls.objects(key=key).first()
-        if not config:
+        values = cls._get_snapshot()
+        if key not in values:
             return default
-        return config.get_typed_value()
+        return values[key]
 
     @classmethod
     def get_configs(cls):
         """获取所有配置项"""
-        configs = {}
-        for config in cls.objects:
-            configs[config.key] = config.get_typed_value()
-        return configs
+        return dict(cls._get_snapshot())
 
     @classmethod
     def get_message_configs(cls):
@@ -194,12 +441,8 @@ class SiteConfig(db.Document):
             'nav_message_text',
             'nav_message_visible',
         ]
-        configs = {}
-        for key in keys:
-            config = cls.objects(key=key).first()
-            if config:
-                configs[key] = config.get_typed_value()
-        return configs
+        values = cls._get_snapshot()
+        return {key: values[key] for key in keys if key in values}
 
     def get_typed_value(self):
         """获取类型转换后的值"""
@@ -253,9 +496,43 @@ class Message(db.Document):
     meta = {
         'collection': 'message',
         'ordering': ['-created_at'],
-        'indexes': ['ip_address', 'created_at', 'is_public'],
+        'indexes': [
+            'ip_address',
+            'created_at',
+            # 留言墙只读取公开留言
+            ('is_public', '-created_at'),
+            # sweep-uploads 按存储文件名核对留言附件
+            'attachment.stored_filename',
+        ],
     }
 
+    # 进程内留言墙候选池：[{'content': ..., 'contact': ...}]
+    _wall_pool = TagSnapshot('message-wall', '留言墙')
+
+    @classmethod
+    def get_wall_pool(cls):
+        """
+        获取留言墙候选池
+
+        候选池是最新的 MESSAGE_WALL_POOL_SIZE 条公开留言，后台公开、取消公开或删除公开留言后
+        重新加载。
+        """
+
+        def load():
+            size = current_app.config.get('MESSAGE_WALL_POOL_SIZE', 500)
+            messages = (
+                cls.objects(is_public=True)
+                .only('content', 'contact')
+                .order_by('-created_at')
+                .limit(size)
+                .as_pymongo()
+            )
+            return [
+                {'content': msg['content'], 'contact': msg.get('contact', '匿名')} for msg in messages
+            ]
+
+        return cls._wall_pool.get(load)
+
     @property
     def local_created_at(self):
         """获取本地时区的创建时间"""
@@ -270,25 +547,85 @@ class IPRecord(db.Document):
     is_blocked = db.BooleanField(default=False)  # 是否被禁止留言
     last_message_at = db.DateTimeField()  # 最后留言时间
 
-    meta = {'collection': 'ip_record', 'indexes': ['ip_address', 'is_blocked']}
+    meta = {
+        'collection': 'ip_record',
+        # 后台 IP 记录列表按最后留言时间排序
+        'indexes': ['ip_address', 'is_blocked', '-last_message_at'],
+    }
+
+
+class Counter(db.Document):
+    """计数器，保存分页需要的文档总数，见 utils/counters.py"""
+
+    name = db.StringField(required=True, unique=True)  # 计数器名，如 posts:visible
+    value = db.IntField(default=0)  # 计数
+
+    meta = {'collection': 'counters', 'indexes': ['name']}
 
 
 class Cache(db.Document):
     """缓存集合"""
 
     key = db.StringField(required=True, unique=True)  # 缓存键
+    view = db.StringField()  # 视图函数名
     value = db.StringField(required=True)  # 缓存值（JSON字符串）
+    size = db.IntField(default=0)  # 缓存值的字节数
     created_at = db.DateTimeField(default=datetime.utcnow)  # 创建时间
+    expires_at = db.DateTimeField()  # 过期时间，由 TTL 索引自动清理
+    tags = db.ListField(db.StringField())  # 缓存标签，用于按标签失效
+    tag_versions = db.DictField()  # 写入时各标签的版本号
 
     meta = {
         'collection': 'caches',
         'indexes': [
             'key',
-            {'fields': ['created_at'], 'expireAfterSeconds': 3600},  # 1小时后自动过期
+            'view',
+            'tags',
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},  # 到达 expires_at 后自动删除
         ],
     }
 
 
+class CacheTag(db.Document):
+    """缓存标签版本，每次按标签失效时版本号加一，各 worker 据此同步清理进程内缓存"""
+
+    tag = db.StringField(required=True, unique=True)  # 标签名，如 post:<id>、post-list
+    version = db.IntField(default=0)  # 版本号
+    updated_at = db.DateTimeField(default=datetime.utcnow)  # 最后失效时间
+
+    meta = {'collection': 'cache_tags', 'indexes': ['tag', 'updated_at']}
+
+
+class CacheLease(db.Document):
+    """缓存计算租约，同一缓存键同时只允许一个 worker 执行视图函数"""
+
+    key = db.StringField(required=True, unique=True)  # 缓存键
+    owner = db.StringField()  # 持有者标识
+    expires_at = db.DateTimeField()  # 租约到期时间，持有者异常退出时由其他 worker 接管
+
+    meta = {
+        'collection': 'cache_leases',
+        'indexes': ['key', {'fields': ['expires_at'], 'expireAfterSeconds': 0}],
+    }
+
+
+class CacheStat(db.Document):
+    """缓存统计，各 worker 定期累加计数，按视图汇总"""
+
+    view = db.StringField(required=True, unique=True)  # 视图函数名
+    memory_hits = db.IntField(default=0)  # 进程内缓存命中
+    mongo_hits = db.IntField(default=0)  # MongoDB 缓存命中
+    stale_hits = db.IntField(default=0)  # 返回旧值
+    misses = db.IntField(default=0)  # 未命中
+    not_modified = db.IntField(default=0)  # 返回 304
+    errors = db.IntField(default=0)  # 缓存操作失败
+    computes = db.IntField(default=0)  # 执行视图函数次数
+    compute_seconds = db.FloatField(default=0)  # 执行视图函数总耗时
+    hit_seconds = db.FloatField(default=0)  # 命中时的总耗时
+
+    meta = {'collection': 'cache_stats', 'indexes': ['view']}
+
+
 class SiteShare(db.Document):
     """好站分享模型"""
 
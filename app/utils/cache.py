@@ -1,61 +1,840 @@
 """
 缓存装饰器模块
 用于提供数据库查询结果的缓存功能
+
+缓存分为两级：
+    一级：进程内 LRU 缓存（MemoryCache），按条目数和字节数限制容量，命中时不访问数据库
+    二级：MongoDB 的 caches 集合，多个 worker 进程共享
+
+缓存条目可以带标签（如 post:<id>、post-list、site-config、siteshare），
+后台修改数据后调用 invalidate_tags 按标签清除相关页面。标签版本记录在
+cache_tags 集合中，各 worker 定期同步版本号，清理自己进程内的过期条目。
+
+设置 hard_duration 的视图在 duration 到期后、hard_duration 到期前，直接返回旧页面，
+同时由后台线程池重新执行视图函数刷新缓存（stale-while-revalidate）。
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from flask import current_app, request
+from flask import current_app, request, session, make_response
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+from werkzeug.wrappers import Response as BaseResponse
+import hashlib
+from mongoengine.errors import NotUniqueError
+from pymongo import UpdateOne
+import threading
 import time
 import json
-from ..models import Cache
+import uuid
+from ..models import Cache, CacheLease, CacheStat, CacheTag
+from ..constants import VERSION
+
+# 一级缓存未命中时的返回值，用于区分缓存值本身为 None 的情况
+_MISSING = object()
+
+# 同步标签版本时向前多查询的时间，容忍各 worker 之间的时钟偏差
+_SYNC_OVERLAP = timedelta(seconds=30)
 
 
-def cache_for(duration=300):
+class MemoryCache:
     """
-    数据库静态缓存装饰器
+    进程内 LRU 缓存
+
+    每个条目记录值、占用字节数、过期时间和变旧时间。超过条目数或字节数上限时，
+    从最久未使用的条目开始淘汰。所有操作都在锁内完成，可在多线程 worker 中使用。
+    """
+
+    def __init__(self, max_entries=512, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size, expires_at, tags, stale_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def init_app(self, app):
+        """从应用配置读取容量限制"""
+        self.max_entries = app.config.get('CACHE_MEMORY_MAX_ENTRIES', self.max_entries)
+        self.max_bytes = app.config.get('CACHE_MEMORY_MAX_BYTES', self.max_bytes)
+        app.extensions['memory_cache'] = self
+
+    def get(self, key):
+        """
+        获取缓存值
+
+        Returns:
+            缓存值；未命中或已过期时返回 _MISSING
+        """
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """
+        获取缓存值及其是否已经变旧
+
+        Returns:
+            tuple: (缓存值, 是否已过变旧时间)；未命中或已过期时缓存值为 _MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return _MISSING, False
+            value, _, expires_at, _, stale_at = entry
+            now = time.time()
+            if expires_at <= now:
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return _MISSING, False
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value, stale_at <= now
+
+    def set(self, key, value, ttl, size, tags=(), fresh_ttl=None):
+        """
+        写入缓存
+
+        Args:
+            key (str): 缓存键
+            value: 缓存值
+            ttl (float): 剩余有效时间，单位秒
+            size (int): 缓存值占用的字节数
+            tags (iterable): 缓存标签
+            fresh_ttl (float): 剩余新鲜时间，单位秒，之后的读取视为旧值；默认与 ttl 相同
+        """
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        now = time.time()
+        stale_at = now + (ttl if fresh_ttl is None else fresh_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, now + ttl, frozenset(tags), stale_at)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        """删除单个缓存条目"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def purge_tags(self, tags):
+        """删除带有任一指定标签的缓存条目"""
+        tags = set(tags)
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[3] & tags]
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        """清空所有缓存条目"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        """返回当前容量和统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                **self.stats,
+            }
+
+    def _remove(self, key):
+        """移除条目并更新字节计数，调用方需持有锁"""
+        size = self._entries.pop(key)[1]
+        self._bytes -= size
+
+
+class TagVersions:
+    """
+    缓存标签版本表
+
+    在进程内保存 cache_tags 集合的副本，每隔 interval 秒增量同步一次。
+    发现其他 worker 使某个标签失效后，清理本进程内带有该标签的缓存条目。
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._versions = {}
+        self._updated_at = {}  # 标签最后失效时间（UTC）
+        self._synced_at = None  # 上次同步的单调时钟时间
+        self._watermark = None  # 上次同步时的 UTC 时间
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """从应用配置读取同步间隔"""
+        self.interval = app.config.get('CACHE_TAG_SYNC_INTERVAL', self.interval)
+
+    def get(self, tag):
+        """获取标签的当前版本号，从未失效过的标签为 0"""
+        return self._versions.get(tag, 0)
+
+    def snapshot(self, tags):
+        """获取一组标签的当前版本号"""
+        return {tag: self.get(tag) for tag in tags}
+
+    def last_modified(self, tags):
+        """获取一组标签中最近一次失效的时间，都未失效过时返回 None"""
+        times = [self._updated_at[tag] for tag in tags if tag in self._updated_at]
+        return max(times) if times else None
+
+    def update(self, tag, version, updated_at):
+        """记录本进程刚刚完成的失效操作"""
+        if version > self.get(tag):
+            self._versions[tag] = version
+            self._updated_at[tag] = updated_at.replace(tzinfo=timezone.utc)
+
+    def sync(self, force=False):
+        """
+        从 MongoDB 增量同步标签版本
+
+        未到同步间隔时直接返回；其他线程正在同步时也直接返回，不阻塞请求。
+        """
+        now = time.monotonic()
+        if not force and self._synced_at is not None and now - self._synced_at < self.interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            watermark = datetime.utcnow()
+            query = CacheTag.objects
+            if self._watermark is not None:
+                query = query(updated_at__gte=self._watermark - _SYNC_OVERLAP)
+            changed = []
+            for doc in query.only('tag', 'version', 'updated_at'):
+                if doc.version != self.get(doc.tag):
+                    self._versions[doc.tag] = doc.version
+                    self._updated_at[doc.tag] = doc.updated_at.replace(tzinfo=timezone.utc)
+                    changed.append(doc.tag)
+            # 首次同步时本进程内还没有缓存条目，无需清理
+            if changed and self._watermark is not None:
+                memory_cache.purge_tags(changed)
+            self._watermark = watermark
+            self._synced_at = now
+        finally:
+            self._lock.release()
+
+
+# 每个 worker 进程一个实例
+memory_cache = MemoryCache()
+tag_versions = TagVersions()
+
+
+def flush_stats(force=False):
+    """
+    将各视图的统计计数累加到 cache_stats 集合
+
+    每隔 CACHE_STATS_FLUSH_INTERVAL 秒最多写入一次，多个 worker 的计数在数据库中汇总。
+    """
+    global _stats_flushed_at
+
+    now = time.monotonic()
+    interval = current_app.config.get('CACHE_STATS_FLUSH_INTERVAL', 10)
+    if not force and _stats_flushed_at is not None and now - _stats_flushed_at < interval:
+        return
+    _stats_flushed_at = now
+    for view, cached_view in list(cached_views.items()):
+        stats = cached_view.take_stats()
+        if not any(stats.values()):
+            continue
+        try:
+            CacheStat.objects(view=view).update_one(
+                upsert=True, **{f'inc__{name}': value for name, value in stats.items()}
+            )
+        except Exception:
+            # 写入失败时把计数放回去，下次再写
+            cached_view.record(**stats)
+            raise
+
+
+def get_cache_report():
+    """
+    汇总缓存统计，供后台缓存页面使用
+
+    Returns:
+        list: 每个视图一项，包含命中计数、平均耗时、MongoDB 中的条目数和字节数
+    """
+    flush_stats(force=True)
+    stats = {stat.view: stat for stat in CacheStat.objects}
+    usage = {
+        row['_id']: row
+        for row in Cache.objects.aggregate(
+            {
+                '$group': {
+                    '_id': '$view',
+                    'entries': {'$sum': 1},
+                    'bytes': {'$sum': '$size'},
+                }
+            }
+        )
+    }
+    report = []
+    for view in sorted(set(cached_views) | set(stats)):
+        stat = stats.get(view)
+        row = {name: getattr(stat, name, 0) or 0 for name in STAT_FIELDS}
+        hits = row['memory_hits'] + row['mongo_hits'] + row['stale_hits']
+        requests = hits + row['misses'] + row['not_modified']
+        row.update(
+            view=view,
+            requests=requests,
+            hit_ratio=(hits + row['not_modified']) / requests if requests else 0,
+            avg_hit_ms=row['hit_seconds'] / hits * 1000 if hits else 0,
+            avg_compute_ms=row['compute_seconds'] / row['computes'] * 1000
+            if row['computes']
+            else 0,
+            entries=usage.get(view, {}).get('entries', 0),
+            bytes=usage.get(view, {}).get('bytes', 0),
+        )
+        report.append(row)
+    return report
+
+
+def purge_views(*views):
+    """清除指定视图（默认全部视图）的缓存，其他 worker 在同步标签版本时清理"""
+    views = views or tuple(cached_views)
+    invalidate_tags(*[f'view:{view}' for view in views])
+
+
+def invalidate_tags(*tags):
+    """
+    按标签使缓存失效
+
+    递增 cache_tags 中的版本号，删除 MongoDB 中带有这些标签的缓存，
+    并立即清理本进程内的缓存；其他 worker 在下一次同步标签版本时清理。
 
     Args:
-        duration (int): 缓存时间，单位秒，默认5分钟
+        *tags (str): 缓存标签，如 post:<id>、post-list
+    """
+    tags = [tag for tag in tags if tag]
+    if not tags:
+        return
+    try:
+        now = datetime.utcnow()
+        # 所有标签的版本号在一次批量写入中递增，再一次读回，批量操作大量文章时不会逐个往返
+        CacheTag._get_collection().bulk_write(
+            [
+                UpdateOne(
+                    {'tag': tag},
+                    {'$inc': {'version': 1}, '$set': {'updated_at': now}},
+                    upsert=True,
+                )
+                for tag in tags
+            ],
+            ordered=False,
+        )
+        for doc in CacheTag.objects(tag__in=tags).only('tag', 'version', 'updated_at'):
+            tag_versions.update(doc.tag, doc.version, doc.updated_at)
+        Cache.objects(tags__in=tags).delete()
+        current_app.logger.info(f"缓存已失效: {', '.join(tags)}")
+    except Exception as e:
+        current_app.logger.error(f"缓存失效操作失败: {str(e)}")
+    finally:
+        memory_cache.purge_tags(tags)
+
+
+def _not_modified(etag, last_modified):
+    """判断客户端缓存的页面是否仍然有效"""
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+class KeyLocks:
+    """按缓存键分配的进程内锁，同一个键同时只有一个线程执行视图函数"""
+
+    def __init__(self):
+        self._locks = {}  # key -> [Lock, 引用计数]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key, timeout):
+        """
+        获取键对应的锁
+
+        Yields:
+            bool: 是否在 timeout 秒内获得了锁；未获得时调用方自行执行视图函数
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+key_locks = KeyLocks()
+
+
+def _acquire_lease(cache_key, owner):
+    """
+    获取跨 worker 的计算租约
+
+    租约文档不存在或已过期时获取成功；其他 worker 持有未过期租约时，
+    upsert 会因 key 唯一索引冲突而失败。
+    """
+    now = datetime.utcnow()
+    lease_seconds = current_app.config.get('CACHE_LEASE_SECONDS', 30)
+    try:
+        CacheLease.objects(key=cache_key, expires_at__lt=now).update_one(
+            set__owner=owner,
+            set__expires_at=now + timedelta(seconds=lease_seconds),
+            upsert=True,
+        )
+        return True
+    except NotUniqueError:
+        return False
+
+
+def _release_lease(cache_key, owner):
+    """释放自己持有的租约"""
+    try:
+        CacheLease.objects(key=cache_key, owner=owner).delete()
+    except Exception as e:
+        current_app.logger.error(f"释放缓存租约失败: {str(e)}")
+
+
+def _read_entry(cache_key):
+    """
+    读取二级缓存
 
     Returns:
-        function: 装饰器函数
+        tuple: (缓存值, 字节数, 已缓存秒数)；不存在或写入后标签失效过时缓存值为 _MISSING
     """
+    cache = Cache.objects(key=cache_key).first()
 
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            # 生成缓存键，包含query参数
-            query_string = "&".join(f"{k}={v}" for k, v in sorted(request.args.items()))
-            cache_key = f"{f.__name__}:{str(args)}:{str(kwargs)}:{query_string}"
+    # 写入后标签失效过的缓存不可用
+    if not cache or cache.tag_versions != tag_versions.snapshot(cache.tags):
+        return _MISSING, 0, None
 
-            try:
-                # 查找缓存
-                cache = Cache.objects(key=cache_key).first()
+    # created_at 以不带时区的 UTC 时间存储
+    created_at = cache.created_at.replace(tzinfo=timezone.utc)
+    age = time.time() - created_at.timestamp()
+    return json.loads(cache.value), len(cache.value.encode('utf-8')), age
+
+
+def int_param(default=None):
+    """
+    生成整数查询参数的规范化函数，用于 cache_for 的 key_params
+
+    无法转换为整数或等于默认值时返回 None，即不参与缓存键，
+    这样 ?page=1、?page=01 和不带 page 参数的请求共用同一个缓存条目。
+    """
+
+    def normalize(value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return None if value == default else value
+
+    return normalize
+
+
+class ViewKeys:
+    """
+    记录每个视图最近使用的缓存键
+
+    同一视图的不同缓存键超过上限时，返回最久未使用的键，由调用方从两级缓存中删除，
+    防止随机查询参数产生大量只访问一次的缓存条目。
+    """
+
+    def __init__(self):
+        self._keys = {}  # view -> OrderedDict(key -> None)
+        self._lock = threading.Lock()
+
+    def touch(self, view, key, max_keys):
+        """
+        记录一次缓存键的使用
+
+        Returns:
+            list: 超出上限被淘汰的缓存键
+        """
+        with self._lock:
+            keys = self._keys.setdefault(view, OrderedDict())
+            keys[key] = None
+            keys.move_to_end(key)
+            evicted = []
+            while len(keys) > max_keys:
+                evicted.append(keys.popitem(last=False)[0])
+            return evicted
+
+    def discard(self, view=None):
+        """清除一个视图（默认全部视图）的键记录"""
+        with self._lock:
+            if view is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(view, None)
+
+
+view_keys = ViewKeys()
+
+# 所有被 cache_for 装饰的视图，键为视图名
+cached_views = {}
 
-                # 如果找到缓存且未过期
-                if cache and time.time() - cache.created_at.timestamp() < duration:
-                    current_app.logger.info(f"从缓存获取数据: {cache_key}")
-                    return json.loads(cache.value)
+# 每个视图统计的计数项，定期以 $inc 累加到 cache_stats 集合
+STAT_FIELDS = (
+    'memory_hits',  # 进程内缓存命中
+    'mongo_hits',  # MongoDB 缓存命中
+    'stale_hits',  # 返回旧值
+    'misses',  # 未命中
+    'not_modified',  # 返回 304
+    'errors',  # 缓存操作失败
+    'computes',  # 执行视图函数次数（含后台刷新）
+    'compute_seconds',  # 执行视图函数总耗时
+    'hit_seconds',  # 命中时的总耗时
+)
+_stats_flushed_at = None
 
-                # 执行原函数
-                result = f(*args, **kwargs)
+# 后台刷新缓存的线程池，首次使用时按配置创建
+_refresh_executor = None
+_refresh_lock = threading.Lock()
+_refreshing = set()  # 正在后台刷新的缓存键
 
-                # 更新或创建缓存
-                cache_data = {'key': cache_key, 'value': json.dumps(result)}
 
-                if cache:
-                    Cache.objects(key=cache_key).update_one(**cache_data, upsert=True)
-                else:
-                    Cache(**cache_data).save()
+class CachedView:
+    """
+    被 cache_for 装饰的视图
+
+    保存视图的缓存策略，负责生成缓存键、读写两级缓存和后台刷新。
+    """
+
+    def __init__(self, f, duration, hard_duration, tags, key_params, max_keys):
+        self.f = f
+        self.view = f.__name__
+        self.duration = duration
+        self.hard_duration = max(hard_duration or duration, duration)
+        self.tags = tags
+        self.key_params = key_params
+        self.max_keys = max_keys
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+        self._stats_lock = threading.Lock()
+
+    def make_key(self, args, kwargs):
+        """
+        生成缓存键
+
+        只有 key_params 中声明的查询参数参与缓存键，参数值经过规范化，规范化结果为
+        None 或空字符串的参数被忽略。未声明 key_params 时使用全部查询参数。
+        结果为 "视图名:哈希值"，长度固定。
+        """
+        if self.key_params is None:
+            params = sorted(request.args.items())
+        else:
+            params = []
+            for name, normalize in sorted(self.key_params.items()):
+                value = request.args.get(name)
+                if value is not None and normalize is not None:
+                    value = normalize(value)
+                if value is not None and value != '':
+                    params.append((name, value))
+        raw = json.dumps([args, sorted(kwargs.items()), params], ensure_ascii=False, default=str)
+        return f"{self.view}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+    def make_tags(self, args, kwargs):
+        """生成缓存标签列表，每个条目都带有 view:<视图名> 标签，用于按视图清除"""
+        tags = self.tags
+        tags = list(tags(*args, **kwargs) if callable(tags) else tags or ())
+        return tags + [f'view:{self.view}']
+
+    def evict(self, cache_key):
+        """
+        记录缓存键的使用，并删除该视图超出数量上限的旧缓存键
+        """
+        max_keys = self.max_keys or current_app.config.get('CACHE_MAX_KEYS_PER_VIEW', 1000)
+        for key in view_keys.touch(self.view, cache_key, max_keys):
+            memory_cache.delete(key)
+            try:
+                Cache.objects(key=key).delete()
+            except Exception as e:
+                current_app.logger.error(f"删除缓存失败: {key}, {str(e)}")
 
-                current_app.logger.info(f"更新缓存: {cache_key}")
+    def wait_for_entry(self, cache_key, entry_tags):
+        """等待持有租约的 worker 写入缓存，超时返回 _MISSING"""
+        deadline = time.monotonic() + current_app.config.get('CACHE_LEASE_WAIT', 3)
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            result, size, age = _read_entry(cache_key)
+            if result is not _MISSING and age < self.duration:
+                memory_cache.set(
+                    cache_key,
+                    result,
+                    self.hard_duration - age,
+                    size,
+                    entry_tags,
+                    self.duration - age,
+                )
                 return result
+        return _MISSING
 
+    def compute(self, args, kwargs, cache_key, entry_tags):
+        """执行视图函数并回填两级缓存"""
+        # 执行前记录标签版本，执行期间发生的失效会让这次写入的缓存在读取时被判为过期
+        versions = tag_versions.snapshot(entry_tags)
+
+        # 执行原函数
+        start = time.perf_counter()
+        result = self.f(*args, **kwargs)
+        self.record(computes=1, compute_seconds=time.perf_counter() - start)
+
+        # 视图函数设置了闪现消息，或返回了完整的响应（重定向、设置 Cookie 等）时，
+        # 结果只属于当前请求，不写入缓存
+        if session.get('_flashes') or isinstance(result, BaseResponse):
+            return result
+
+        # 更新或创建缓存，使用 upsert 避免并发写入时与唯一索引冲突
+        value = json.dumps(result)
+        size = len(value.encode('utf-8'))
+        now = datetime.utcnow()
+        Cache.objects(key=cache_key).update_one(
+            set__value=value,
+            set__size=size,
+            set__view=self.view,
+            set__created_at=now,
+            set__expires_at=now + timedelta(seconds=self.hard_duration),
+            set__tags=entry_tags,
+            set__tag_versions=versions,
+            upsert=True,
+        )
+        if versions == tag_versions.snapshot(entry_tags):
+            memory_cache.set(
+                cache_key,
+                result,
+                self.hard_duration,
+                size,
+                entry_tags,
+                self.duration,
+            )
+
+        current_app.logger.debug(f"更新缓存: {cache_key}")
+        return result
+
+    def schedule_refresh(self, args, kwargs, cache_key, entry_tags):
+        """
+        提交后台刷新任务
+
+        同一个键在本进程内同时只有一个刷新任务；任务在模拟的请求上下文中重新执行视图函数，
+        并和前台请求一样通过租约避免多个 worker 重复刷新。没有拿到租约时等待持有租约的 worker
+        写入缓存，再读入本进程的内存缓存。
+        """
+        global _refresh_executor
+
+        app = current_app._get_current_object()
+        with _refresh_lock:
+            if cache_key in _refreshing:
+                return
+            _refreshing.add(cache_key)
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(
+                    max_workers=app.config.get('CACHE_REFRESH_WORKERS', 2),
+                    thread_name_prefix='cache-refresh',
+                )
+
+        def refresh():
+            owner = uuid.uuid4().hex
+            try:
+                with app.test_request_context(path, base_url=base_url, query_string=query_string):
+                    if not _acquire_lease(cache_key, owner):
+                        # 其他 worker 正在刷新，等它写入后把新值放入本进程的缓存，
+                        # 否则本进程一直返回旧值并反复提交刷新任务
+                        self.wait_for_entry(cache_key, entry_tags)
+                        return
+                    try:
+                        self.compute(args, kwargs, cache_key, entry_tags)
+                    finally:
+                        _release_lease(cache_key, owner)
+            except Exception as e:
+                app.logger.error(f"后台刷新缓存失败: {cache_key}, {str(e)}")
+            finally:
+                with _refresh_lock:
+                    _refreshing.discard(cache_key)
+
+        path, base_url, query_string = request.path, request.url_root, request.query_string
+        try:
+            _refresh_executor.submit(refresh)
+        except RuntimeError as e:
+            # 解释器退出时线程池已关闭
+            with _refresh_lock:
+                _refreshing.discard(cache_key)
+            current_app.logger.error(f"提交后台刷新任务失败: {str(e)}")
+
+    def record(self, **counts):
+        """累加统计计数"""
+        with self._stats_lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def take_stats(self):
+        """取出并清零尚未写入数据库的统计计数"""
+        with self._stats_lock:
+            stats, self.stats = self.stats, dict.fromkeys(STAT_FIELDS, 0)
+        return stats
+
+    def get(self, args, kwargs, cache_key, entry_tags):
+        """获取缓存值，并记录命中类型和耗时"""
+        start = time.perf_counter()
+        result, outcome = self._get(args, kwargs, cache_key, entry_tags)
+        if outcome:
+            self.record(**{outcome: 1, 'hit_seconds': time.perf_counter() - start})
+        return result
+
+    def _get(self, args, kwargs, cache_key, entry_tags):
+        """
+        依次查询两级缓存，都未命中时执行视图函数并回填缓存
+
+        同一个键的并发未命中只由一个请求执行视图函数：本进程内用 KeyLocks 排队，
+        跨 worker 用 cache_leases 集合中的短期租约协调。没有拿到租约的请求优先返回
+        已过期的旧值，没有旧值时短暂等待持有租约的 worker 写入缓存。
+
+        hard_duration 大于 duration 时，缓存时间在两者之间的旧值直接返回，
+        并提交后台刷新任务。
+
+        Returns:
+            tuple: (结果, 命中类型)；命中类型为 memory_hits、mongo_hits、stale_hits，
+                执行了视图函数时为 None
+        """
+        duration, hard_duration = self.duration, self.hard_duration
+        self.evict(cache_key)
+
+        # 一级缓存：进程内存
+        result, stale = memory_cache.lookup(cache_key)
+        if result is not _MISSING:
+            if stale:
+                self.schedule_refresh(args, kwargs, cache_key, entry_tags)
+                return result, 'stale_hits'
+            return result, 'memory_hits'
+
+        # 排队超时后不再等待，直接继续后面的流程
+        with key_locks.hold(cache_key, current_app.config.get('CACHE_LEASE_WAIT', 3)):
+            # 排队期间同进程的其他线程可能已经写入缓存
+            result = memory_cache.get(cache_key)
+            if result is not _MISSING:
+                return result, 'memory_hits'
+
+            owner = None
+            try:
+                # 二级缓存：MongoDB
+                result, size, age = _read_entry(cache_key)
+                if result is not _MISSING and age < duration:
+                    current_app.logger.debug(f"从缓存获取数据: {cache_key}")
+                    memory_cache.set(
+                        cache_key, result, hard_duration - age, size, entry_tags, duration - age
+                    )
+                    return result, 'mongo_hits'
+                if result is not _MISSING and hard_duration > duration and age < hard_duration:
+                    memory_cache.set(cache_key, result, hard_duration - age, size, entry_tags, 0)
+                    self.schedule_refresh(args, kwargs, cache_key, entry_tags)
+                    return result, 'stale_hits'
+
+                owner = uuid.uuid4().hex
+                if not _acquire_lease(cache_key, owner):
+                    owner = None
+                    if result is not _MISSING:
+                        return result, 'stale_hits'
+                    result = self.wait_for_entry(cache_key, entry_tags)
+                    if result is not _MISSING:
+                        return result, 'mongo_hits'
+
+                self.record(misses=1)
+                return self.compute(args, kwargs, cache_key, entry_tags), None
+
+            except HTTPException:
+                # 视图函数主动返回的 HTTP 错误（如 404）不是缓存故障
+                raise
             except Exception as e:
                 current_app.logger.error(f"缓存操作失败: {str(e)}")
+                self.record(errors=1)
                 # 如果缓存操作失败，直接返回原函数结果
+                return self.f(*args, **kwargs), None
+            finally:
+                if owner:
+                    _release_lease(cache_key, owner)
+
+
+def cache_for(
+    duration=300, tags=None, etag=False, hard_duration=None, key_params=None, max_keys=None
+):
+    """
+    数据库静态缓存装饰器
+
+    先查进程内缓存，未命中再查 MongoDB 缓存，都未命中时执行视图函数并回填两级缓存。
+
+    开启 etag 后，响应带有由页面内容生成的 ETag 以及标签最后失效时间作为
+    Last-Modified。客户端携带的 If-None-Match / If-Modified-Since 仍然有效时，
+    返回不带正文的 304，页面内容直接取自缓存。
+
+    Args:
+        duration (int): 缓存时间，单位秒，默认5分钟
+        tags (list | callable): 缓存标签，或接收视图参数、返回标签列表的函数
+        etag (bool): 是否支持条件请求
+        hard_duration (int): 旧值最长保留时间，单位秒；大于 duration 时开启后台刷新，
+            默认与 duration 相同
+        key_params (dict): 参与缓存键的查询参数及其规范化函数（可为 None），
+            默认使用全部查询参数
+        max_keys (int): 该视图最多保留的缓存键数量，默认取 CACHE_MAX_KEYS_PER_VIEW
+
+    Returns:
+        function: 装饰器函数
+    """
+
+    def decorator(f):
+        cached_view = CachedView(f, duration, hard_duration, tags, key_params, max_keys)
+        cached_views[cached_view.view] = cached_view
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            cache_key = cached_view.make_key(args, kwargs)
+            entry_tags = cached_view.make_tags(args, kwargs)
+
+            # 先同步其他 worker 的失效操作，再读一级缓存
+            try:
+                tag_versions.sync()
+                flush_stats()
+            except Exception as e:
+                current_app.logger.error(f"同步缓存标签失败: {str(e)}")
+
+            # 有待显示的闪现消息时页面内容因人而异，既不读取也不写入缓存
+            if session.get('_flashes'):
                 return f(*args, **kwargs)
+            if not etag:
+                return cached_view.get(args, kwargs, cache_key, entry_tags)
+
+            result = cached_view.get(args, kwargs, cache_key, entry_tags)
+            if not isinstance(result, str):
+                return result
+            # ETag 由页面内容生成，缓存条目重新生成后内容不同的页面不会被误判为未修改
+            page_etag = hashlib.sha1(f"{VERSION}:{result}".encode('utf-8')).hexdigest()
+            last_modified = tag_versions.last_modified(entry_tags)
+            if _not_modified(page_etag, last_modified):
+                cached_view.record(not_modified=1)
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(result)
+            response.set_etag(page_etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # 要求浏览器每次都带上验证信息重新请求，保证后台修改后能立即看到新内容
+            response.cache_control.no_cache = True
+            return response
 
+        decorated_function.cached_view = cached_view
         return decorated_function
 
     return decorator
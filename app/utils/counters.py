@@ -0,0 +1,136 @@
+"""
+计数器模块
+分页需要的文档总数保存在 counters 集合中，写入文章和留言时用 $inc 原子更新，
+渲染页面时只读取一个计数器文档，不再对集合执行 count()
+
+计数器不存在时（首次部署或被删除）从数据库统计一次并写入，
+数据不一致时可以用 flask reconcile-counters 命令重建。
+"""
+
+from collections import defaultdict
+
+from flask import current_app
+
+from ..models import Counter, Post, Message, IPRecord
+
+POSTS = 'posts'  # 全部文章
+VISIBLE_POSTS = 'posts:visible'  # 可见文章
+MESSAGES = 'messages'  # 全部留言
+IP_RECORDS = 'ip_records'  # IP 记录
+
+
+def category_counter(category_id):
+    """某个分类下可见文章的计数器名"""
+    return f'posts:visible:category:{category_id}'
+
+
+def post_counters(post):
+    """
+    文章计入的计数器
+
+    Args:
+        post (Post): 文章，为 None 时表示文章不存在
+
+    Returns:
+        set: 计数器名集合
+    """
+    if post is None:
+        return set()
+    names = {POSTS}
+    if post.is_visible:
+        names.add(VISIBLE_POSTS)
+        names.update(category_counter(getattr(ref, 'id', ref)) for ref in post.categories or ())
+    return names
+
+
+def incr(*names, delta=1):
+    """
+    原子地增减计数器
+
+    只更新已存在的计数器，不存在的计数器在下次读取时从数据库统计。
+    更新失败时只记录日志，不影响写入操作本身。
+    """
+    for name in names:
+        try:
+            Counter.objects(name=name).update_one(inc__value=delta)
+        except Exception as e:
+            current_app.logger.error(f"更新计数器失败: {name}, 错误: {str(e)}")
+
+
+def move(before, after):
+    """
+    根据修改前后计入的计数器调整计数
+
+    Args:
+        before (set): 修改前计入的计数器，新建时为空集合
+        after (set): 修改后计入的计数器，删除时为空集合
+    """
+    incr(*(before - after), delta=-1)
+    incr(*(after - before), delta=1)
+
+
+def move_many(changes):
+    """
+    批量调整计数，每个计数器只更新一次
+
+    Args:
+        changes (iterable): (修改前计入的计数器, 修改后计入的计数器) 序列
+    """
+    deltas = defaultdict(int)
+    for before, after in changes:
+        for name in before - after:
+            deltas[name] -= 1
+        for name in after - before:
+            deltas[name] += 1
+    for name, delta in deltas.items():
+        if delta:
+            incr(name, delta=delta)
+
+
+def get(name, count):
+    """
+    读取计数器
+
+    Args:
+        name (str): 计数器名
+        count (callable): 计数器不存在时统计实际数量的函数
+
+    Returns:
+        int: 计数
+    """
+    counter = Counter.objects(name=name).only('value').first()
+    if counter is not None:
+        return max(counter.value, 0)
+    value = count()
+    Counter.objects(name=name).update_one(upsert=True, set_on_insert__value=value)
+    current_app.logger.info(f"初始化计数器: {name} = {value}")
+    return value
+
+
+def reconcile():
+    """
+    从数据库重新统计全部计数器
+
+    Returns:
+        dict: {计数器名: 计数}
+    """
+    values = {
+        POSTS: Post.objects.count(),
+        VISIBLE_POSTS: Post.objects(is_visible=True).count(),
+        MESSAGES: Message.objects.count(),
+        IP_RECORDS: IPRecord.objects.count(),
+    }
+    pipeline = [
+        {'$match': {'is_visible': True}},
+        {'$unwind': '$categories'},
+        {'$group': {'_id': '$categories', 'count': {'$sum': 1}}},
+    ]
+    for row in Post.objects.aggregate(pipeline):
+        category_id = getattr(row['_id'], 'id', row['_id'])
+        values[category_counter(category_id)] = row['count']
+
+    for name, value in values.items():
+        Counter.objects(name=name).update_one(upsert=True, set__value=value)
+    # 没有可见文章的分类和已不再使用的计数器不再保留，分类计数器读取时会重新统计
+    Counter.objects(name__nin=list(values)).delete()
+    return values
@@ -1,7 +1,35 @@
+import hashlib
 import os
-import uuid
+import shutil
+import string
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from flask import current_app
+from urllib.parse import quote
+from flask import current_app, request
+from flask.wrappers import Request
+from werkzeug.utils import send_file
+from werkzeug.exceptions import RequestEntityTooLarge, RequestedRangeNotSatisfiable
+from werkzeug.http import http_date, parse_if_range_header, parse_range_header
+from werkzeug.wsgi import wrap_file
+from ..models import Blob, get_utc_time
+
+# 上传过程中临时文件的文件名前缀，未保存的临时文件由 sweep-uploads 命令清理
+UPLOAD_TEMP_PREFIX = '.upload-'
+# 保存后文件的权限：mkstemp 创建的临时文件只有属主可读写，改名前按 umask 恢复为普通文件权限，
+# 否则以其他用户运行的 Web 服务器无法直接发送附件。umask 只能通过设置读取，在导入时读取一次
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+UPLOAD_FILE_MODE = 0o666 & ~_UMASK
+# 多段 Range 请求最多处理的区间数，超出时返回完整文件
+MAX_RANGES = 16
+# 多段 Range 响应每次读取的字节数
+RANGE_CHUNK_SIZE = 64 * 1024
+
+# 后台删除文件的线程池，首次使用时创建
+_delete_executor = None
+_delete_lock = threading.Lock()
 
 
 def ensure_upload_folder():
@@ -42,20 +70,200 @@ def sanitize_filename(filename):
     return filename or 'unnamed'
 
 
-def save_file(file):
+def upload_size_limit(filename):
+    """
+    返回上传文件的大小上限
+
+    Args:
+        filename (str): 上传的文件名，按扩展名查找 UPLOAD_SIZE_LIMITS 配置
+    Returns:
+        int: 字节数，没有单独配置的类型使用 MAX_CONTENT_LENGTH，都未配置时为 None
+    """
+    ext = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    limits = current_app.config.get('UPLOAD_SIZE_LIMITS') or {}
+    return limits.get(ext, current_app.config.get('MAX_CONTENT_LENGTH'))
+
+
+class UploadStream:
+    """
+    上传文件的写入流
+
+    表单解析时文件内容直接写入上传目录中的临时文件，写入的同时计算大小和 SHA-256，
+    超过该类型的大小上限时立即删除临时文件并中止请求。
+    保存时把临时文件改名为最终文件，整个上传过程只写一次磁盘；
+    没有保存的临时文件在关闭时删除。
+
+    Attributes:
+        size (int): 已写入的字节数
+        temp_path (str): 临时文件路径
+    """
+
+    def __init__(self, folder, filename=None, max_size=None):
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=str(folder), prefix=UPLOAD_TEMP_PREFIX, suffix='.part'
+        )
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.filename = filename
+        self.max_size = max_size
+        self.size = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        # read、seek 等方法直接使用临时文件的
+        return getattr(self.__dict__['_file'], name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    @property
+    def sha256(self):
+        """已写入内容的 SHA-256"""
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        """写入一段数据，超过大小上限时抛出 RequestEntityTooLarge"""
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            current_app.logger.warning(f"上传文件超过大小限制: {self.filename}, 上限 {self.max_size} 字节")
+            raise RequestEntityTooLarge()
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def commit(self, file_path):
+        """
+        把临时文件改名为最终文件
+
+        Args:
+            file_path (str|Path): 最终文件路径，需要与临时文件在同一个文件系统
+        """
+        self._file.close()
+        os.chmod(self.temp_path, UPLOAD_FILE_MODE)
+        os.replace(self.temp_path, str(file_path))
+        self._done = True
+
+    def close(self):
+        """关闭流，没有保存的临时文件被删除"""
+        self._file.close()
+        if not self._done:
+            self._done = True
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequest(Request):
+    """
+    请求类，上传文件不再先缓存到系统临时目录，而是直接写入上传目录
+
+    没有文件名的空文件字段仍使用 Werkzeug 默认的缓存方式。
+    """
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        if not filename:
+            return super()._get_file_stream(
+                total_content_length, content_type, filename, content_length
+            )
+        stream = UploadStream(ensure_upload_folder(), filename, upload_size_limit(filename))
+        # 解析中途失败时已创建的流不在 request.files 中，在这里记录以便清理
+        self.__dict__.setdefault('_upload_streams', []).append(stream)
+        return stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self.__dict__.get('_upload_streams', ()):
+                stream.close()
+
+
+def _upload_stream(file, folder):
+    """
+    返回写入了上传文件全部内容的 UploadStream
+
+    由 UploadRequest 解析的文件直接使用，其他来源的文件按块复制到 folder 中的临时文件。
+    """
+    stream = file.stream
+    if isinstance(stream, UploadStream) and not stream._done:
+        return stream
+    stream = UploadStream(folder, file.filename, upload_size_limit(file.filename))
+    try:
+        shutil.copyfileobj(file.stream, stream)
+    except BaseException:
+        stream.close()
+        raise
+    return stream
+
+
+def save_upload(file, file_path):
+    """
+    把上传的文件保存到指定路径
+
+    由 UploadRequest 解析的文件直接改名，其他来源的文件按块复制，同样计算大小和 SHA-256。
+
+    Args:
+        file: FileStorage对象，上传的文件
+        file_path (str|Path): 保存路径
+    Returns:
+        tuple: (文件大小（字节）, SHA-256)
+    """
+    stream = _upload_stream(file, Path(file_path).parent)
+    stream.commit(file_path)
+    return stream.size, stream.sha256
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """按块计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_filename(sha256, ext):
+    """按内容生成存储文件名"""
+    return f'{sha256}{ext.lower()}'
+
+
+def acquire_file(stored_filename, sha256, size):
+    """
+    增加一个附件文件的引用，没有存储记录时新建
+
+    Args:
+        stored_filename (str): 存储文件名
+        sha256 (str): 文件内容的 SHA-256
+        size (int): 文件大小（字节）
+    """
+    Blob.objects(stored_filename=stored_filename).update_one(
+        upsert=True,
+        inc__refs=1,
+        set_on_insert__sha256=sha256,
+        set_on_insert__size=size,
+        set_on_insert__created_at=get_utc_time(),
+    )
+
+
+def save_file(file, acquire=True):
     """
     保存上传的文件并返回存储信息
+
+    文件按内容命名，已经存在相同内容的文件时只增加引用数。
     Args:
         file: FileStorage对象，上传的文件
+        acquire (bool): 是否同时占用一个引用；留言预览上传的文件在提交时才占用，
+            放弃提交的文件由 sweep-uploads 命令清理
     Returns:
-        dict: 包含文件信息的字典，如果保存失败返回None
+        dict: 包含文件信息的字典，file_size 为字节数，如果保存失败返回None
     """
     if not file or not file.filename:
         current_app.logger.warning("No file or filename provided")
         return None
     try:
-        # 保存原始文件名
-        original_filename = file.filename
         # 分离文件名和扩展名
         if '.' in file.filename:
             name_base, ext = file.filename.rsplit('.', 1)
@@ -65,21 +273,343 @@ def save_file(file):
             ext = ''
         safe_name_base = sanitize_filename(name_base)
         original_filename = safe_name_base + ext
-        stored_filename = f"{uuid.uuid4().hex}{ext}"
         upload_folder = ensure_upload_folder()
-        file_path = upload_folder / stored_filename
-        file.save(str(file_path))
-        if not file_path.exists():
-            current_app.logger.error("File was not saved successfully")
-            raise Exception("File was not saved successfully")
-        file_size = os.path.getsize(str(file_path))
+        stream = _upload_stream(file, upload_folder)
+        stored_filename = blob_filename(stream.sha256, ext)
+        if acquire:
+            acquire_file(stored_filename, stream.sha256, stream.size)
+        # 内容相同，已有文件时直接覆盖：改名是原子操作，
+        # 也避免与同时释放最后一个引用的请求竞争时丢失文件
+        try:
+            stream.commit(upload_folder / stored_filename)
+        except Exception:
+            if acquire:
+                release_files([stored_filename])
+            raise
         file_info = {
             'filename': original_filename,
             'stored_filename': stored_filename,
             'file_type': ext[1:] if ext else '',
-            'file_size': file_size,
+            'file_size': stream.size,
+            'sha256': stream.sha256,
         }
         return file_info
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         current_app.logger.error(f"File save error: {str(e)}")
         return None
+
+
+def release_files(stored_filenames):
+    """
+    释放附件文件的引用
+
+    Args:
+        stored_filenames (iterable): 存储文件名，每出现一次释放一个引用
+    Returns:
+        list: 已没有引用、应当删除的文件路径
+    """
+    upload_folder = ensure_upload_folder()
+    unused = []
+    for name in stored_filenames:
+        if not name or os.path.basename(name) != name:
+            current_app.logger.warning(f"忽略无效的存储文件名: {name}")
+            continue
+        blob = Blob.objects(stored_filename=name).modify(dec__refs=1, new=True)
+        if blob is None:
+            # 去重迁移之前上传、没有存储记录的文件只被一处引用
+            unused.append(upload_folder / name)
+        elif blob.refs <= 0 and Blob.objects(id=blob.id, refs__lte=0).delete():
+            unused.append(upload_folder / name)
+    return unused
+
+
+def remove_released_file(path):
+    """
+    删除已经没有引用的附件文件
+
+    释放最后一个引用与删除文件之间，相同内容的新上传可能已经重新建立存储记录并认为文件存在。
+    因此先把文件改名，再确认存储记录仍不存在；记录已存在时把文件改回原名。
+    文件按内容命名，改回的内容与新上传的相同，新上传在改名之后写入的文件也不会被删除。
+
+    Args:
+        path (str|Path): 文件路径
+    Returns:
+        bool: 文件是否被删除
+    """
+    path = Path(path)
+    trash = path.with_name(f'{UPLOAD_TEMP_PREFIX}{os.urandom(8).hex()}.deleting')
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return False
+    if Blob.objects(stored_filename=path.name).only('id').first() is not None:
+        os.replace(trash, path)
+        return False
+    os.remove(trash)
+    return True
+
+
+def release_file(stored_filename):
+    """
+    释放一个附件文件的引用，没有其他引用时立即删除文件
+
+    Returns:
+        bool: 文件是否被删除
+    """
+    deleted = False
+    for path in release_files([stored_filename]):
+        if remove_released_file(path):
+            deleted = True
+            current_app.logger.info(f"删除附件文件: {path}")
+    return deleted
+
+
+def _file_etag(stored_filename, stat):
+    """按内容命名的文件以 SHA-256 作为 ETag，其他文件使用大小和修改时间"""
+    stem = stored_filename.split('.', 1)[0]
+    if len(stem) == 64 and all(c in string.hexdigits for c in stem):
+        return stem.lower()
+    return f'{stat.st_size:x}-{int(stat.st_mtime):x}'
+
+
+def _if_range_matches(environ, etag, mtime):
+    """
+    检查 If-Range 条件
+
+    客户端缓存的版本与当前文件一致时才按 Range 返回部分内容，否则返回完整文件。
+    只接受强验证器：弱 ETag 不匹配，日期必须与 Last-Modified 完全相同。
+    """
+    header = environ.get('HTTP_IF_RANGE')
+    if not header:
+        return True
+    if header.startswith('W/'):
+        return False
+    if_range = parse_if_range_header(header)
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and http_date(if_range.date) == http_date(int(mtime))
+
+
+def _parse_ranges(header, size):
+    """
+    解析 Range 请求头
+
+    Args:
+        header (str): Range 请求头
+        size (int): 文件大小
+    Returns:
+        list: 按顺序合并相邻区间后的 (开始, 结束) 字节区间，不含结束位置；
+            请求头无效或区间过多时返回 None，表示忽略 Range 返回完整文件；
+            没有可满足的区间时返回空列表
+    """
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+        return None
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start >= stop:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(stop, ranges[-1][1]))
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+
+class _RangeFile:
+    """
+    只能读取文件中一个区间的文件对象
+
+    交给 WSGI 服务器的 wsgi.file_wrapper 发送：gunicorn 等服务器从文件当前偏移按
+    Content-Length 调用 sendfile 零拷贝发送，其他服务器通过 read() 读取，同样不会超出区间。
+    """
+
+    def __init__(self, path, start, length):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _multipart_ranges(path, ranges, size, content_type):
+    """
+    生成 multipart/byteranges 响应正文
+
+    Returns:
+        tuple: (边界字符串, 正文长度, 正文生成器)
+    """
+    boundary = os.urandom(16).hex()
+    headers = [
+        (
+            f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+        ).encode('ascii')
+        for start, stop in ranges
+    ]
+    closing = f'--{boundary}--\r\n'.encode('ascii')
+    length = sum(len(h) + stop - start + 2 for h, (start, stop) in zip(headers, ranges))
+
+    def generate():
+        with open(path, 'rb') as f:
+            for header, (start, stop) in zip(headers, ranges):
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b'\r\n'
+        yield closing
+
+    return boundary, length + len(closing), generate()
+
+
+def _send_file_ranges(file_path, stored_filename, download_name):
+    """
+    由 Flask 发送文件，支持缓存验证和 Range 请求
+
+    完整文件和单个区间通过 wsgi.file_wrapper 发送，多个区间返回 multipart/byteranges。
+    """
+    environ = request.environ
+    stat = os.stat(file_path)
+    etag = _file_etag(stored_filename, stat)
+    response = send_file(
+        str(file_path),
+        environ,
+        download_name=download_name,
+        as_attachment=True,
+        conditional=False,
+        etag=etag,
+        last_modified=int(stat.st_mtime),
+        response_class=current_app.response_class,
+        _root_path=current_app.root_path,
+    )
+    response.accept_ranges = 'bytes'
+    # 处理 If-None-Match、If-Modified-Since 等条件，Range 在下面单独处理
+    response.make_conditional(environ)
+    if (
+        response.status_code != 200
+        or 'HTTP_RANGE' not in environ
+        or not _if_range_matches(environ, etag, stat.st_mtime)
+    ):
+        return response
+
+    size = stat.st_size
+    ranges = _parse_ranges(environ['HTTP_RANGE'], size)
+    if ranges is None:
+        return response
+    response.close()
+    if not ranges:
+        current_app.logger.warning(f"无法满足的 Range 请求: {environ['HTTP_RANGE']}, 文件大小 {size}")
+        return RequestedRangeNotSatisfiable(length=size).get_response(environ)
+
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.response = wrap_file(environ, _RangeFile(file_path, start, stop - start))
+        response.content_range = f'bytes {start}-{stop - 1}/{size}'
+        response.content_length = stop - start
+    else:
+        boundary, length, body = _multipart_ranges(file_path, ranges, size, response.content_type)
+        response.response = body
+        response.content_type = f'multipart/byteranges; boundary={boundary}'
+        response.content_length = length
+    return response
+
+
+def send_attachment(stored_filename, download_name):
+    """
+    发送附件文件
+
+    ATTACHMENT_OFFLOAD 为 nginx 时返回 X-Accel-Redirect 头，为 sendfile 时返回 X-Sendfile 头，
+    由前端服务器读取并发送文件（包括 Range 和缓存验证），worker 在权限检查后立即释放；
+    留空时由 Flask 发送文件，支持断点续传和多段 Range 请求。
+
+    Args:
+        stored_filename (str): 存储文件名
+        download_name (str): 下载时使用的文件名
+    Returns:
+        Response: 文件响应，文件不存在时返回 None
+    """
+    if not stored_filename or os.path.basename(stored_filename) != stored_filename:
+        return None
+    file_path = ensure_upload_folder() / stored_filename
+    if not file_path.is_file():
+        return None
+
+    offload = current_app.config.get('ATTACHMENT_OFFLOAD')
+    if not offload:
+        return _send_file_ranges(file_path, stored_filename, download_name)
+
+    response = send_file(
+        str(file_path),
+        request.environ,
+        download_name=download_name,
+        as_attachment=True,
+        use_x_sendfile=True,
+        conditional=False,
+        etag=False,
+        response_class=current_app.response_class,
+        _root_path=current_app.root_path,
+    )
+    # 响应没有正文，长度由前端服务器按文件设置
+    del response.headers['Content-Length']
+    if offload == 'nginx':
+        del response.headers['X-Sendfile']
+        prefix = current_app.config.get('ATTACHMENT_OFFLOAD_PREFIX', '/_uploads/')
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{quote(stored_filename)}"
+    return response
+
+
+def delete_files_async(paths, batch_size=50):
+    """
+    在后台线程中删除已经没有引用的附件文件，按批提交，不阻塞请求
+
+    Args:
+        paths (iterable): release_files 返回的文件路径
+        batch_size (int): 每个后台任务删除的文件数
+    """
+    global _delete_executor
+
+    paths = [str(path) for path in paths]
+    if not paths:
+        return
+    app = current_app._get_current_object()
+    with _delete_lock:
+        if _delete_executor is None:
+            _delete_executor = ThreadPoolExecutor(
+                max_workers=app.config.get('FILE_DELETE_WORKERS', 2),
+                thread_name_prefix='file-delete',
+            )
+
+    def delete_batch(batch):
+        for path in batch:
+            try:
+                remove_released_file(path)
+            except Exception as e:
+                app.logger.error(f"删除文件失败: {path}, 错误: {str(e)}")
+        app.logger.info(f"后台删除文件完成，共 {len(batch)} 个")
+
+    for start in range(0, len(paths), batch_size):
+        _delete_executor.submit(delete_batch, paths[start : start + batch_size])
@@ -0,0 +1,206 @@
+"""
+分页模块
+提供基于游标（keyset）的分页，翻到任意深度的页面都只需沿索引读取一页数据
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from flask import abort
+from bson.errors import InvalidId
+from mongoengine.queryset.visitor import Q
+
+# 文章列表的排序，_id 保证排序值相同的文章顺序稳定
+POST_LIST_ORDER = ('-is_pinned', '-updated_at', '-created_at', '-id')
+
+# 后台按标题前缀筛选时指定的索引：排序字段在前、标题在后，沿索引顺序读取，
+# 标题条件在索引中判断，避免选中 title 索引后在内存中排序
+TITLE_FILTER_HINT = [
+    ('is_pinned', -1),
+    ('updated_at', -1),
+    ('created_at', -1),
+    ('_id', -1),
+    ('title', 1),
+]
+
+
+def _to_millis(value):
+    """将数据库中不带时区的 UTC 时间转换为毫秒时间戳"""
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _from_millis(value):
+    """将毫秒时间戳转换为不带时区的 UTC 时间，与数据库中存储的时间一致"""
+    return datetime.fromtimestamp(value / 1000, timezone.utc).replace(tzinfo=None)
+
+
+def encode_post_cursor(post):
+    """
+    生成文章列表的游标
+
+    Args:
+        post (Post): 当前页的最后一篇文章
+
+    Returns:
+        str: URL 安全的游标字符串
+    """
+    data = [
+        bool(post.is_pinned),
+        _to_millis(post.updated_at),
+        _to_millis(post.created_at),
+        str(post.id),
+    ]
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_post_cursor(token):
+    """
+    解析文章列表的游标
+
+    Args:
+        token (str): encode_post_cursor 生成的游标
+
+    Returns:
+        tuple: (是否置顶, 更新时间, 创建时间, ObjectId)；游标无效时返回 None
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        is_pinned, updated_at, created_at, post_id = json.loads(raw)
+        if not isinstance(is_pinned, bool):
+            return None
+        return is_pinned, _from_millis(updated_at), _from_millis(created_at), ObjectId(post_id)
+    except (binascii.Error, ValueError, TypeError, OverflowError, OSError, InvalidId):
+        return None
+
+
+def normalize_post_cursor(token):
+    """cache_for 的 key_params 规范化函数，无效游标不参与缓存键"""
+    cursor = decode_post_cursor(token)
+    return token if cursor else None
+
+
+def _after_post(cursor):
+    """生成排在游标之后的文章的查询条件，与 POST_LIST_ORDER 对应"""
+    is_pinned, updated_at, created_at, post_id = cursor
+    same = {'is_pinned': True} if is_pinned else {'is_pinned__ne': True}
+    # 置顶文章之后是所有非置顶文章（包括没有 is_pinned 字段的旧数据）
+    pinned = Q(is_pinned__ne=True) if is_pinned else Q(id__in=[])
+    return (
+        pinned
+        | Q(updated_at__lt=updated_at, **same)
+        | Q(updated_at=updated_at, created_at__lt=created_at, **same)
+        | Q(updated_at=updated_at, created_at=created_at, id__lt=post_id, **same)
+    )
+
+
+def order_posts(queryset, cursor=None):
+    """
+    按文章列表的顺序排序，带游标时只保留游标之后的文章
+
+    Args:
+        queryset (QuerySet): 文章查询
+        cursor (tuple): decode_post_cursor 的返回值
+
+    Returns:
+        QuerySet: 排序后的查询
+    """
+    if cursor:
+        queryset = queryset.filter(_after_post(cursor))
+    return queryset.order_by(*POST_LIST_ORDER)
+
+
+class CursorPage:
+    """
+    游标分页结果
+
+    不统计总数，只多取一条判断是否有下一页，每一页的查询代价相同。
+
+    Attributes:
+        items (list): 当前页的文章
+        has_next (bool): 是否有下一页
+        next_cursor (str): 下一页的游标，没有下一页时为 None
+    """
+
+    def __init__(self, queryset, cursor, per_page):
+        items = list(order_posts(queryset, cursor).limit(per_page + 1))
+        self.per_page = per_page
+        self.has_next = len(items) > per_page
+        self.items = items[:per_page]
+        self.next_cursor = encode_post_cursor(self.items[-1]) if self.has_next else None
+
+
+class NumberedPage:
+    """
+    页码分页结果
+
+    与 flask_mongoengine 的 paginate() 相同的属性，但不调用 select_related()，
+    配合 no_dereference() 使用时不会加载引用的文档。
+
+    Attributes:
+        items (list): 当前页的文档
+        page (int): 当前页码
+        pages (int): 总页数
+        total (int): 总文档数
+    """
+
+    def __init__(self, queryset, page, per_page, total=None):
+        if page < 1:
+            abort(404)
+        self.page = page
+        self.per_page = per_page
+        # 调用方可以传入维护好的计数，避免 count() 扫描
+        self.total = queryset.count() if total is None else total
+        self.items = list(queryset.skip((page - 1) * per_page).limit(per_page))
+        if not self.items and page != 1:
+            abort(404)
+
+    @property
+    def pages(self):
+        """总页数"""
+        return max(1, -(-self.total // self.per_page))
+
+    @property
+    def has_prev(self):
+        """是否有上一页"""
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        """是否有下一页"""
+        return self.page < self.pages
+
+    @property
+    def prev_num(self):
+        """上一页页码"""
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        """下一页页码"""
+        return self.page + 1
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+        """
+        生成分页导航的页码，省略的部分用 None 表示
+
+        只遍历首尾和当前页附近的页码，与总页数无关。当前页之后显示 right_current - 1 页，
+        与原来列表页使用的分页导航一致。
+        """
+        last = 0
+        windows = (
+            (1, left_edge),
+            (self.page - left_current, self.page + right_current - 1),
+            (self.pages - right_edge + 1, self.pages),
+        )
+        for start, end in windows:
+            for num in range(max(start, last + 1, 1), min(end, self.pages) + 1):
+                if num != last + 1:
+                    yield None
+                yield num
+                last = num
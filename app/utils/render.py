@@ -0,0 +1,112 @@
+"""
+Markdown 渲染模块
+将 Markdown 文章预先渲染为 HTML 并保存在 Post 中，文章详情页直接使用渲染结果
+"""
+
+import hashlib
+import html
+import re
+import markdown
+from flask import current_app
+
+from ..models import Post, SiteConfig
+
+# 与文章详情页一致的渲染扩展
+MARKDOWN_EXTENSIONS = ['extra', 'codehilite', 'toc']
+
+_TAG_RE = re.compile(r'<(script|style)\b.*?</\1>|<[^>]+>', re.IGNORECASE | re.DOTALL)
+_SPACE_RE = re.compile(r'\s+')
+
+
+def render_markdown(md_text):
+    """
+    渲染 Markdown 文本
+
+    Args:
+        md_text (str): Markdown 源文本
+
+    Returns:
+        tuple: (正文 HTML, 目录 HTML)
+    """
+    md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    html = md.convert(md_text)
+    return html, md.toc
+
+
+def render_post_markdown(post, force=False):
+    """
+    渲染 Markdown 文章并写入 rendered_html、rendered_toc 和 source_hash 字段
+
+    源文件的 SHA-256 与 source_hash 相同时跳过渲染。只修改字段，不保存文章。
+
+    Args:
+        post (Post): Markdown 文章
+        force (bool): 是否忽略 source_hash 强制重新渲染
+
+    Returns:
+        bool: 是否重新渲染
+    """
+    if not post.is_markdown or not post.md_file_path:
+        return False
+    with open(post.md_file_path, 'r', encoding='utf-8') as f:
+        md_text = f.read()
+    source_hash = hashlib.sha256(md_text.encode('utf-8')).hexdigest()
+    if not force and post.source_hash == source_hash and post.rendered_html is not None:
+        return False
+    post.rendered_html, post.rendered_toc = render_markdown(md_text)
+    post.source_hash = source_hash
+    return True
+
+
+def html_to_text(source):
+    """去掉 HTML 标签并合并空白，返回纯文本"""
+    text = html.unescape(_TAG_RE.sub(' ', source or ''))
+    return _SPACE_RE.sub(' ', text).strip()
+
+
+def excerpt_length():
+    """
+    文章摘要保存的字符数
+
+    列表页按网站设置中的预览长度截取摘要，保存的摘要取预览长度和 POST_EXCERPT_LENGTH
+    中较大的一个，后台调大预览长度后列表页仍能显示足够的内容。
+    """
+    preview_length = int(SiteConfig.get_config('content_preview_length', 200) or 0)
+    return max(preview_length, current_app.config.get('POST_EXCERPT_LENGTH', 300))
+
+
+def make_excerpt(post, length=None):
+    """
+    生成文章摘要
+
+    Markdown 文章取预渲染的 HTML，普通文章取正文，去掉标签后截取。
+
+    Args:
+        post (Post): 文章
+        length (int): 摘要的最大字符数，默认取 excerpt_length()
+
+    Returns:
+        str: 纯文本摘要
+    """
+    if length is None:
+        length = excerpt_length()
+    source = post.rendered_html if post.is_markdown else post.content
+    return html_to_text(source)[:length]
+
+
+def rebuild_excerpts():
+    """
+    按当前的摘要长度重新生成全部文章的摘要
+
+    Returns:
+        int: 摘要有变化的文章数
+    """
+    length = excerpt_length()
+    updated = 0
+    fields = ('content', 'is_markdown', 'rendered_html', 'excerpt')
+    for post in Post.objects.only(*fields).order_by():
+        excerpt = make_excerpt(post, length)
+        if excerpt != post.excerpt:
+            Post.objects(id=post.id).update_one(set__excerpt=excerpt)
+            updated += 1
+    return updated
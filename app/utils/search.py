@@ -0,0 +1,161 @@
+"""
+全文搜索模块
+为文章标题和正文建立倒排索引，中文按二元组切分，英文和数字按单词切分
+
+每篇文章在 search_index 集合中对每个词项保存一行 (term, post, weight)，
+搜索时按词项查出候选文章，用 TF-IDF 打分排序。
+"""
+
+import math
+import re
+from collections import Counter
+
+from flask import current_app
+from markupsafe import Markup, escape
+
+from ..models import Post, SearchTerm
+from .render import html_to_text
+
+# 中日韩文字按二元组切分，其余字母数字按单词切分
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_TOKEN_RE = re.compile(f'([{_CJK}]+)|([^\\W_{_CJK}]+)')
+
+# 标题中的词项权重
+TITLE_WEIGHT = 3
+
+
+def _iter_tokens(text, unigrams):
+    """
+    切分文本
+
+    Args:
+        text (str): 待切分的文本
+        unigrams (bool): 中文是否同时输出单字，建立索引时为 True，
+            这样只有一个汉字的搜索词也能命中
+
+    Yields:
+        str: 小写的词项
+    """
+    for cjk, word in _TOKEN_RE.findall(text.lower()):
+        if word:
+            yield word
+            continue
+        if len(cjk) == 1 or unigrams:
+            yield from cjk
+        for i in range(len(cjk) - 1):
+            yield cjk[i : i + 2]
+
+
+def tokenize(text):
+    """切分搜索词，返回去重后的词项列表"""
+    return list(dict.fromkeys(_iter_tokens(text or '', unigrams=False)))
+
+
+def index_post(post):
+    """
+    重建一篇文章的索引行
+
+    正文取预渲染 HTML（普通文章取正文）去掉标签后的纯文本，标签名、属性和代码块语言
+    等标记不会进入索引。
+
+    Args:
+        post (Post): 已保存的文章
+    """
+    weights = Counter()
+    for term in _iter_tokens(post.title or '', unigrams=True):
+        weights[term] += TITLE_WEIGHT
+    for term in _iter_tokens(html_to_text(post.rendered_html or post.content), unigrams=True):
+        weights[term] += 1
+
+    SearchTerm.objects(post=post.id).delete()
+    if weights:
+        # 按文章长度归一化，长文章不会因为词多而排在前面
+        length = math.sqrt(sum(weights.values()))
+        SearchTerm.objects.insert(
+            [
+                SearchTerm(term=term, post=post.id, weight=weight / length)
+                for term, weight in weights.items()
+            ],
+            load_bulk=False,
+        )
+
+
+def remove_posts(post_ids):
+    """删除文章的索引行"""
+    SearchTerm.objects(post__in=list(post_ids)).delete()
+
+
+def search_post_ids(query, limit=None):
+    """
+    搜索文章
+
+    命中词项多的文章排在前面，命中数相同时按 TF-IDF 得分排序。
+
+    Args:
+        query (str): 搜索词
+        limit (int): 最多返回的文章数，默认读取 SEARCH_MAX_RESULTS 配置
+
+    Returns:
+        list: 按相关度排序的文章 ID
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+    limit = limit or current_app.config.get('SEARCH_MAX_RESULTS', 200)
+
+    rows = SearchTerm.objects(term__in=terms).only('term', 'post', 'weight').as_pymongo()
+    postings = {}
+    for row in rows:
+        postings.setdefault(row['term'], []).append((row['post'], row['weight']))
+
+    total = max(Post.objects.count(), 1)
+    scores = {}
+    for term, posting in postings.items():
+        idf = math.log(1 + total / len(posting))
+        for post_id, weight in posting:
+            matched, score = scores.get(post_id, (0, 0.0))
+            scores[post_id] = (matched + 1, score + weight * idf)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return ranked[:limit]
+
+
+def highlight(text, query, length=None):
+    """
+    高亮搜索词
+
+    Args:
+        text (str): 原文
+        query (str): 搜索词
+        length (int): 截取的摘要长度，为 None 时不截取
+
+    Returns:
+        Markup: 转义后的 HTML，命中的部分包在 <mark> 中
+    """
+    text = text or ''
+    words = sorted(
+        {w for w in re.split(r'\s+', query.strip()) if w}
+        | {t for t in tokenize(query) if len(t) > 1},
+        key=len,
+        reverse=True,
+    )
+    if not words:
+        return escape(text[:length] if length else text)
+    pattern = re.compile('|'.join(re.escape(w) for w in words), re.IGNORECASE)
+
+    if length and len(text) > length:
+        match = pattern.search(text)
+        start = max(0, match.start() - length // 4) if match else 0
+        snippet = text[start : start + length]
+        prefix = '…' if start else ''
+        suffix = '…' if start + length < len(text) else ''
+    else:
+        snippet, prefix, suffix = text, '', ''
+
+    parts, pos = [], 0
+    for match in pattern.finditer(snippet):
+        parts.append(escape(snippet[pos : match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group())
+        pos = match.end()
+    parts.append(escape(snippet[pos:]))
+    return Markup(prefix) + Markup('').join(parts) + Markup(suffix)
@@ -16,6 +16,42 @@ class Config:
     JSON_AS_ASCII = False  # 确保 JSON 响应可以包含非 ASCII 字符
     BABEL_DEFAULT_LOCALE = 'zh_CN'  # 设置默认语言为中文
     TIMEZONE = 'Asia/Shanghai'  # 设置时区为中国时区
+    # 进程内页面缓存（一级缓存）容量限制，每个 worker 进程独立
+    CACHE_MEMORY_MAX_ENTRIES = int(os.environ.get('CACHE_MEMORY_MAX_ENTRIES', 512))
+    CACHE_MEMORY_MAX_BYTES = int(os.environ.get('CACHE_MEMORY_MAX_BYTES', 32 * 1024 * 1024))
+    # 各 worker 同步缓存标签失效记录的间隔（秒），即其他进程看到失效的最长延迟
+    CACHE_TAG_SYNC_INTERVAL = float(os.environ.get('CACHE_TAG_SYNC_INTERVAL', 2))
+    # 缓存未命中时计算租约的有效期，以及其他请求等待租约持有者写入缓存的最长时间（秒）
+    CACHE_LEASE_SECONDS = int(os.environ.get('CACHE_LEASE_SECONDS', 30))
+    CACHE_LEASE_WAIT = float(os.environ.get('CACHE_LEASE_WAIT', 3))
+    # 后台刷新过期页面缓存的线程数，每个 worker 进程独立
+    CACHE_REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', 2))
+    # 每个视图在每个 worker 中最多保留的缓存键数量，超出后淘汰最久未使用的键
+    CACHE_MAX_KEYS_PER_VIEW = int(os.environ.get('CACHE_MAX_KEYS_PER_VIEW', 1000))
+    # 缓存命中统计写入数据库的间隔（秒）
+    CACHE_STATS_FLUSH_INTERVAL = float(os.environ.get('CACHE_STATS_FLUSH_INTERVAL', 10))
+    # 首页前几页使用页码分页，之后按游标翻页
+    POST_LIST_NUMBERED_PAGES = int(os.environ.get('POST_LIST_NUMBERED_PAGES', 5))
+    # 搜索最多返回的文章数
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 200))
+    # 文章摘要至少保存的字符数，网站设置中的预览长度更大时按预览长度保存，列表页再按预览长度截取
+    POST_EXCERPT_LENGTH = int(os.environ.get('POST_EXCERPT_LENGTH', 300))
+    # 留言墙从最新的多少条公开留言中随机展示
+    MESSAGE_WALL_POOL_SIZE = int(os.environ.get('MESSAGE_WALL_POOL_SIZE', 500))
+    # 批量删除文章时后台删除附件文件的线程数
+    FILE_DELETE_WORKERS = int(os.environ.get('FILE_DELETE_WORKERS', 2))
+    # 按扩展名限制单个上传文件的大小（字节），上传过程中超出即中止；
+    # 未列出的类型只受 MAX_CONTENT_LENGTH 限制
+    UPLOAD_SIZE_LIMITS = {
+        'md': 2 * 1024 * 1024,
+    }
+    # 附件下载交给前端服务器发送，worker 只做权限检查：
+    # nginx 使用 X-Accel-Redirect，sendfile 使用 X-Sendfile（Apache、lighttpd），留空时由 Flask 发送
+    ATTACHMENT_OFFLOAD = os.environ.get('ATTACHMENT_OFFLOAD', '')
+    # nginx 中映射到 uploads 目录的 internal location
+    ATTACHMENT_OFFLOAD_PREFIX = os.environ.get('ATTACHMENT_OFFLOAD_PREFIX', '/_uploads/')
+    # sweep-uploads 只清理修改时间早于多少小时的未引用文件，留出留言预览到提交的时间
+    UPLOAD_SWEEP_GRACE_HOURS = float(os.environ.get('UPLOAD_SWEEP_GRACE_HOURS', 24))
 
     @staticmethod
     def init_app(app):
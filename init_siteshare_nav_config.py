@@ -4,6 +4,7 @@
 """
 from app import create_app
 from app.models import SiteConfig
+from app.utils.cache import invalidate_tags
 import os
 
 # 如有需要可修改环境
@@ -41,4 +42,6 @@ with app.app_context():
         else:
             print(f"已存在配置项: {item['key']} = {config.value}")
 
+    # 通知正在运行的 worker 重新加载配置快照
+    invalidate_tags('site-config')
     print("好站分享导航栏配置检查完毕。")
@@ -3,6 +3,7 @@
 
 from app import create_app
 from app.models import SiteConfig
+from app.utils.cache import invalidate_tags
 
 
 def reset_config():
@@ -24,6 +25,9 @@ def reset_config():
             print('警告：找不到初始化函数，尝试重新创建应用...')
             app = create_app()  # 重新创建应用以触发初始化
 
+        # 通知正在运行的 worker 重新加载配置快照
+        invalidate_tags('site-config')
+
         # 验证配置是否已创建
         configs = SiteConfig.objects.all()
         print('\n当前配置项：')